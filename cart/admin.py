@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import CartLine
 
-# Register your models here.
+@admin.register(CartLine)
+class CartLineAdmin(admin.ModelAdmin):
+    list_display = ('user', 'product', 'quantity', 'selected_size', 'updated_at')
+    list_filter = ('updated_at',)
+    search_fields = ('user__username', 'product__name')
+    raw_id_fields = ('user', 'product')
@@ -1,6 +1,68 @@
-from store.models import Product, Profile
+from django.conf import settings
+from django.db import transaction
+from store.models import Product
+from .models import CartLine
+import hashlib
 import json
 
+
+def persist_cart(request):
+    """
+    Save the session cart to the user's CartLine rows.
+    Skips the write when the cart is unchanged since the last save.
+    """
+    cart = request.session.get('session_key', {})
+    digest = hashlib.md5(json.dumps(cart, sort_keys=True).encode()).hexdigest()
+    if request.session.get('saved_cart_digest') == digest:
+        return False
+
+    user = request.user
+    # Only keep lines whose product still exists
+    product_ids = list(Product.objects.filter(
+        id__in=[int(key) for key in cart if str(key).isdigit()]
+    ).values_list('id', flat=True))
+    lines = [
+        CartLine(
+            user=user,
+            product_id=product_id,
+            quantity=cart[str(product_id)]['quantity'],
+            selected_size=cart[str(product_id)].get('selected_size') or '',
+            custom_size=cart[str(product_id)].get('custom_size') or '',
+        )
+        for product_id in product_ids
+    ]
+
+    with transaction.atomic():
+        # Drop removed lines, then upsert the rest
+        CartLine.objects.filter(user=user).exclude(product_id__in=product_ids).delete()
+        if lines:
+            CartLine.objects.bulk_create(
+                lines,
+                update_conflicts=True,
+                unique_fields=['user', 'product'],
+                update_fields=['quantity', 'selected_size', 'custom_size', 'updated_at'],
+            )
+
+    request.session['saved_cart_digest'] = digest
+    return True
+
+
+def load_saved_cart(user):
+    """
+    Get a user's saved cart in session cart format, with one query
+    """
+    lines = CartLine.objects.filter(user=user).values_list(
+        'product_id', 'quantity', 'selected_size', 'custom_size')
+    return {
+        str(product_id): {
+            'quantity': quantity,
+            'selected_size': selected_size,
+            'custom_size': custom_size
+        }
+        for product_id, quantity, selected_size, custom_size in lines
+    }
+
+
 class Cart():
     def __init__(self, request):
         self.session = request.session
@@ -15,6 +77,21 @@ class Cart():
 
         # Make sure cart is available on all pages of site
         self.cart = cart
+        # Priced snapshot of the cart, built on first use
+        self._priced = None
+
+    def mark_dirty(self):
+        """
+        Flag the cart for saving to its CartLine rows.
+        With CART_WRITE_BEHIND on (the default) CartPersistenceMiddleware
+        writes it once at the end of the request.
+        """
+        if not self.request.user.is_authenticated:
+            return
+        if getattr(settings, 'CART_WRITE_BEHIND', True):
+            self.request.cart_dirty = True
+        else:
+            persist_cart(self.request)
 
     def db_add(self, product, quantity, selected_size=None, custom_size=None):
         product_id = str(product.id)  # Fixed: use product.id, not product object
@@ -44,15 +121,10 @@ class Cart():
             }
 
         self.session.modified = True
+        self._priced = None
 
         # Deal with logged in user
-        if self.request.user.is_authenticated:
-            # Get the current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            # Save cart as proper JSON
-            cart_json = json.dumps(self.cart)
-            # Save carty to the Profile Model
-            current_user.update(old_cart=cart_json)
+        self.mark_dirty()
 
     def add(self, product, quantity, selected_size=None, custom_size=None):
         product_id = str(product.id)
@@ -67,50 +139,62 @@ class Cart():
             }
 
         self.session.modified = True
+        self._priced = None
 
         # Deal with logged in user
-        if self.request.user.is_authenticated:
-            # Get the current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            # Save cart as proper JSON
-            cart_json = json.dumps(self.cart)
-            # Save carty to the Profile Model
-            current_user.update(old_cart=cart_json)
+        self.mark_dirty()
 
-    def cart_total(self):
-        # Get product IDS
-        product_ids = self.cart.keys()
-        # lookup those keys in our products database model
-        products = Product.objects.filter(id__in=product_ids)
-        # Get quantities
-        quantities = self.cart
-        # Start counting at 0
+    def get_priced(self):
+        """
+        Price every cart line in a single pass.
+        Products are loaded once into an id-keyed map and the result is
+        kept on the cart until it is changed.
+        """
+        if self._priced is not None:
+            return self._priced
+
+        # Look up every product in the cart with one query
+        product_ids = [int(key) for key in self.cart.keys() if str(key).isdigit()]
+        products = Product.objects.select_related('category').in_bulk(product_ids)
+
+        lines = []
         total = 0
-        
-        for key, item_data in quantities.items():
-            # Convert key string into into so we can do math
-            key = int(key)
+        for key, item_data in self.cart.items():
+            if not str(key).isdigit():
+                continue
+            product = products.get(int(key))
+            # Product might have been deleted, skip it
+            if product is None:
+                continue
             quantity = item_data['quantity']
-            for product in products:
-                if product.id == key:
-                    if product.is_sale:
-                        total = total + (product.sale_price * quantity)
-                    else:
-                        total = total + (product.price * quantity)
+            price = product.effective_price
+            line_total = price * quantity
+            lines.append({
+                'product': product,
+                'quantity': quantity,
+                'selected_size': item_data.get('selected_size', ''),
+                'custom_size': item_data.get('custom_size', ''),
+                'price': price,
+                'line_total': line_total,
+            })
+            total = total + line_total
 
-        return total
+        self._priced = {
+            'lines': lines,
+            'products': [line['product'] for line in lines],
+            'total': total,
+        }
+        return self._priced
+
+    def cart_total(self):
+        return self.get_priced()['total']
 
     def __len__(self):
         return len(self.cart)
 
     def get_prods(self):
-        # Get ids from cart
-        product_ids = self.cart.keys()
-        # Use ids to lookup products in database model
-        products = Product.objects.filter(id__in=product_ids)
-
-        # Return those looked up products
-        return products
+        # Products come from the priced snapshot, so no extra query
+        return self.get_priced()['products']
 
     def get_quants(self):
         quantities = {}
@@ -136,15 +220,10 @@ class Cart():
         }
 
         self.session.modified = True
+        self._priced = None
     
         # Deal with logged in user
-        if self.request.user.is_authenticated:
-            # Get the current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            # Save cart as proper JSON
-            cart_json = json.dumps(self.cart)
-            # Save carty to the Profile Model
-            current_user.update(old_cart=cart_json)
+        self.mark_dirty()
 
         thing = self.cart
         return thing
@@ -156,46 +235,42 @@ class Cart():
             del self.cart[product_id]
 
         self.session.modified = True
+        self._priced = None
 
         # Deal with logged in user
-        if self.request.user.is_authenticated:
-            # Get the current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            # Save cart as proper JSON
-            cart_json = json.dumps(self.cart)
-            # Save carty to the Profile Model
-            current_user.update(old_cart=cart_json)
-
-    # New method to restore from saved cart data
-    def restore_from_saved(self, saved_cart_dict):
+        self.mark_dirty()
+
+    def restore_saved(self, increment=False):
         """
-        Restore cart from saved dictionary data
+        Restore the logged in user's saved CartLine rows with one query.
+        With increment=True quantities are added up like db_add, otherwise
+        lines already in the cart are left alone like add.
+        Returns the number of restored lines.
         """
-        for product_id, item_data in saved_cart_dict.items():
-            try:
-                # Skip if product_id is not a valid integer
-                if not str(product_id).isdigit():
+        saved_cart = load_saved_cart(self.request.user)
+        items = [
+            (key, item_data['quantity'], item_data['selected_size'], item_data['custom_size'])
+            for key, item_data in saved_cart.items()
+        ]
+        return self._merge_saved(items, increment)
+
+    def _merge_saved(self, items, increment):
+        restored = 0
+        for key, quantity, selected_size, custom_size in items:
+            if key in self.cart:
+                if not increment:
                     continue
-                    
-                product_id_int = int(product_id)
-                product = Product.objects.get(id=product_id_int)
-                
-                # Extract data
-                if isinstance(item_data, dict):
-                    quantity = item_data.get('quantity', 1)
-                    selected_size = item_data.get('selected_size', '')
-                    custom_size = item_data.get('custom_size', '')
-                else:
-                    quantity = item_data
-                    selected_size = ''
-                    custom_size = ''
-                
-                # Add to cart
-                self.add(
-                    product=product,
-                    quantity=quantity,
-                    selected_size=selected_size,
-                    custom_size=custom_size
-                )
-            except (Product.DoesNotExist, ValueError):
-                continue
\ No newline at end of file
+                self.cart[key]['quantity'] += quantity
+            else:
+                self.cart[key] = {
+                    'quantity': quantity,
+                    'selected_size': selected_size,
+                    'custom_size': custom_size
+                }
+            restored += 1
+
+        if restored:
+            self.session.modified = True
+            self._priced = None
+            self.mark_dirty()
+        return restored
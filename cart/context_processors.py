@@ -1,6 +1,35 @@
+from django.utils.functional import cached_property
 from .cart import Cart
 
+class LazyCart():
+	"""
+	Template stand-in for Cart.
+	The session is only read, and the Cart only built, when a template
+	actually uses it.
+	"""
+	def __init__(self, request):
+		self._request = request
+		self._cart = None
+
+	def _load(self):
+		if self._cart is None:
+			self._cart = Cart(self._request)
+		return self._cart
+
+	@cached_property
+	def count(self):
+		# Navbar badge: number of lines, read straight from the session
+		return len(self._request.session.get('session_key', {}))
+
+	def __len__(self):
+		return self.count
+
+	def __getattr__(self, name):
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return getattr(self._load(), name)
+
 # Create context processor so our cart can work on all pages of the site
 def cart(request):
-	# Return the default data from our Cart
-	return {'cart': Cart(request)}
\ No newline at end of file
+	# Return a lazy cart, so pages that never show it skip the session
+	return {'cart': LazyCart(request)}
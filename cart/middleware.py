@@ -0,0 +1,25 @@
+# cart/middleware.py
+import logging
+from django.utils.deprecation import MiddlewareMixin
+from .cart import persist_cart
+
+logger = logging.getLogger(__name__)
+
+class CartPersistenceMiddleware(MiddlewareMixin):
+    """
+    Write-behind saving of the cart to the CartLine table.
+    Cart changes only mark the request dirty; the cart is saved here
+    once per request, and not at all if it did not change.
+    """
+
+    def process_response(self, request, response):
+        if not getattr(request, 'cart_dirty', False):
+            return response
+
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated and hasattr(request, 'session'):
+            try:
+                persist_cart(request)
+            except Exception:
+                logger.exception("Error saving cart for user %s", user.pk)
+        return response
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.4 on 2026-10-18 05:41
+
+import json
+
+from django.db import migrations
+
+
+def copy_old_carts(apps, schema_editor):
+    """Move every Profile.old_cart JSON string into CartLine rows"""
+    Profile = apps.get_model('store', 'Profile')
+    Product = apps.get_model('store', 'Product')
+    CartLine = apps.get_model('cart', 'CartLine')
+
+    existing_ids = set(Product.objects.values_list('id', flat=True))
+    lines = []
+    for user_id, old_cart in Profile.objects.exclude(old_cart__isnull=True).values_list('user_id', 'old_cart'):
+        try:
+            saved_cart = json.loads(old_cart) if old_cart and old_cart.strip() else {}
+        except json.JSONDecodeError:
+            # Truncated or corrupted cart, nothing to keep
+            continue
+        if not isinstance(saved_cart, dict):
+            continue
+
+        for product_id, item_data in saved_cart.items():
+            if not str(product_id).isdigit() or int(product_id) not in existing_ids:
+                continue
+            # Old format was just the quantity
+            if not isinstance(item_data, dict):
+                item_data = {'quantity': item_data}
+            try:
+                quantity = int(item_data.get('quantity', 1))
+            except (TypeError, ValueError):
+                continue
+            lines.append(CartLine(
+                user_id=user_id,
+                product_id=int(product_id),
+                quantity=quantity,
+                selected_size=item_data.get('selected_size') or '',
+                custom_size=item_data.get('custom_size') or '',
+            ))
+
+    CartLine.objects.bulk_create(lines, batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0001_initial'),
+        ('store', '0012_remove_product_is_featured'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_old_carts, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,25 @@
 from django.db import models
+from django.contrib.auth.models import User
+from store.models import Product
 
-# Create your models here.
+
+# Saved cart of a logged in user, one row per product
+class CartLine(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='cart_lines')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='cart_lines')
+    quantity = models.PositiveIntegerField(default=1)
+    selected_size = models.CharField(max_length=100, blank=True, null=True)
+    custom_size = models.TextField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user.username} - {self.product} x {self.quantity}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='cart_line_user_product'),
+        ]
+        indexes = [
+            # Abandoned cart lookups
+            models.Index(fields=['updated_at'], name='cart_line_updated_idx'),
+        ]
@@ -1,3 +1,297 @@
-from django.test import TestCase
+import json
+from decimal import Decimal
+from unittest import mock
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.urls import reverse
+from payment.models import Order, OrderItem
+from store.models import Category, Product
+from .cart import Cart, load_saved_cart, persist_cart
+from .context_processors import cart as cart_context
+from .models import CartLine
 
-# Create your tests here.
+
+def cart_request(user=None, cart=None):
+	"""A request with a session holding the cart"""
+	request = RequestFactory().get('/')
+	request.session = SessionStore()
+	if cart is not None:
+		request.session['session_key'] = cart
+	request.user = user or AnonymousUser()
+	return request
+
+
+class CartPricingTests(TestCase):
+	"""Cart.get_priced prices every line in one query"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		cls.beret = Product.objects.create(name='Beret', price=30, sale_price=20, is_sale=True, category=hats)
+
+	def cart(self):
+		return Cart(cart_request(cart={
+			str(self.fedora.pk): {'quantity': 2, 'selected_size': '57', 'custom_size': ''},
+			str(self.beret.pk): {'quantity': 1, 'selected_size': '', 'custom_size': '58cm'},
+			# A deleted product is skipped
+			'99999': {'quantity': 1, 'selected_size': '', 'custom_size': ''},
+		}))
+
+	def test_lines_and_total(self):
+		priced = self.cart().get_priced()
+		lines = {line['product'].pk: line for line in priced['lines']}
+		self.assertEqual(set(lines), {self.fedora.pk, self.beret.pk})
+		self.assertEqual(lines[self.fedora.pk]['price'], Decimal('50'))
+		self.assertEqual(lines[self.fedora.pk]['line_total'], Decimal('100'))
+		self.assertEqual(lines[self.fedora.pk]['selected_size'], '57')
+		# Sale items are charged their sale price
+		self.assertEqual(lines[self.beret.pk]['price'], Decimal('20'))
+		self.assertEqual(lines[self.beret.pk]['custom_size'], '58cm')
+		self.assertEqual(priced['total'], Decimal('120'))
+
+	def test_memoized_until_changed(self):
+		cart = self.cart()
+		with self.assertNumQueries(1):
+			cart.cart_total()
+			cart.get_prods()
+			cart.get_priced()
+		cart.update(self.fedora.pk, 3)
+		with self.assertNumQueries(1):
+			self.assertEqual(cart.cart_total(), Decimal('170'))
+		cart.delete(self.beret.pk)
+		with self.assertNumQueries(1):
+			self.assertEqual(cart.cart_total(), Decimal('150'))
+
+
+class ProcessOrderTests(TestCase):
+	"""process_order builds the order items from the priced cart lines"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		cls.beret = Product.objects.create(name='Beret', price=30, sale_price=20, is_sale=True, category=hats)
+		cls.user = User.objects.create_user('buyer', password='secret')
+
+	def place_order(self):
+		session = self.client.session
+		session['session_key'] = {
+			str(self.fedora.pk): {'quantity': 2, 'selected_size': '57', 'custom_size': ''},
+			str(self.beret.pk): {'quantity': 1, 'selected_size': '', 'custom_size': '58cm'},
+		}
+		session['my_shipping'] = {
+			'shipping_full_name': 'Ada Buyer', 'shipping_email': 'ada@example.com',
+			'shipping_address1': '1 Street', 'shipping_address2': '', 'shipping_city': 'Town',
+			'shipping_state': '', 'shipping_zipcode': '1000', 'shipping_country': 'BE',
+		}
+		session.save()
+		return self.client.post(reverse('process_order'), {'card_name': 'Ada'}, secure=True)
+
+	def assertOrdered(self, user=None):
+		order = Order.objects.get()
+		self.assertEqual(order.user, user)
+		self.assertEqual(order.amount_paid, Decimal('120'))
+		items = {item.product_id: item for item in OrderItem.objects.filter(order=order)}
+		self.assertEqual(set(items), {self.fedora.pk, self.beret.pk})
+		self.assertEqual((items[self.fedora.pk].quantity, items[self.fedora.pk].price), (2, Decimal('50')))
+		self.assertEqual(items[self.fedora.pk].selected_size, '57')
+		self.assertEqual((items[self.beret.pk].quantity, items[self.beret.pk].price), (1, Decimal('20')))
+		self.assertEqual(items[self.beret.pk].custom_size, '58cm')
+		self.assertNotIn('session_key', self.client.session)
+
+	def test_guest_order(self):
+		self.assertEqual(self.place_order().status_code, 302)
+		self.assertOrdered()
+
+	def test_user_order(self):
+		self.client.force_login(self.user)
+		CartLine.objects.create(user=self.user, product=self.fedora, quantity=2)
+		self.assertEqual(self.place_order().status_code, 302)
+		self.assertOrdered(self.user)
+		self.assertTrue(all(item.user == self.user for item in OrderItem.objects.all()))
+		# The saved cart is emptied too
+		self.assertFalse(CartLine.objects.filter(user=self.user).exists())
+
+
+class PersistCartTests(TestCase):
+	"""persist_cart writes the session cart to CartLine rows, only when it changed"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		cls.beret = Product.objects.create(name='Beret', price=30, category=hats)
+		cls.user = User.objects.create_user('buyer', password='secret')
+
+	def saved(self):
+		return {line.product_id: (line.quantity, line.selected_size, line.custom_size)
+				for line in CartLine.objects.filter(user=self.user)}
+
+	def test_upsert_and_delete(self):
+		request = cart_request(self.user, {
+			str(self.fedora.pk): {'quantity': 1, 'selected_size': '57', 'custom_size': None},
+			str(self.beret.pk): {'quantity': 2, 'selected_size': None, 'custom_size': '58cm'},
+		})
+		self.assertTrue(persist_cart(request))
+		self.assertEqual(self.saved(), {self.fedora.pk: (1, '57', ''), self.beret.pk: (2, '', '58cm')})
+
+		# Changed quantity is updated in place, removed lines are deleted
+		line = CartLine.objects.get(user=self.user, product=self.fedora)
+		request.session['session_key'] = {
+			str(self.fedora.pk): {'quantity': 4, 'selected_size': '57', 'custom_size': None},
+		}
+		self.assertTrue(persist_cart(request))
+		self.assertEqual(self.saved(), {self.fedora.pk: (4, '57', '')})
+		self.assertEqual(CartLine.objects.get(user=self.user, product=self.fedora).pk, line.pk)
+
+	def test_unchanged_cart_is_skipped(self):
+		request = cart_request(self.user, {str(self.fedora.pk): {'quantity': 1}})
+		self.assertTrue(persist_cart(request))
+		with self.assertNumQueries(0):
+			self.assertFalse(persist_cart(request))
+
+	def test_middleware_writes_once_per_request(self):
+		self.client.force_login(self.user)
+		# add_to_cart marks the cart dirty, the middleware saves it
+		self.client.post(reverse('cart_add'), {
+			'action': 'post', 'product_id': self.fedora.pk, 'product_qty': 2,
+		}, secure=True)
+		self.assertEqual(self.saved(), {self.fedora.pk: (2, '', '')})
+
+	def test_middleware_logs_errors(self):
+		self.client.force_login(self.user)
+		with mock.patch('cart.middleware.persist_cart', side_effect=RuntimeError('down')), \
+				self.assertLogs('cart.middleware', 'ERROR'):
+			response = self.client.post(reverse('cart_add'), {
+				'action': 'post', 'product_id': self.fedora.pk, 'product_qty': 2,
+			}, secure=True)
+		self.assertEqual(response.status_code, 200)
+
+
+class SavedCartMigrationTests(TransactionTestCase):
+	"""cart 0002 copies the old Profile.old_cart JSON into CartLine rows"""
+	before = [('store', '0012_remove_product_is_featured'), ('cart', '0001_initial')]
+	after = [('cart', '0002_copy_profile_old_cart')]
+
+	def setUp(self):
+		self.executor = MigrationExecutor(connection)
+		self.executor.migrate(self.before)
+		self.addCleanup(self.migrate_to_latest)
+
+	def migrate_to_latest(self):
+		executor = MigrationExecutor(connection)
+		executor.migrate(executor.loader.graph.leaf_nodes())
+
+	def test_copy_old_carts(self):
+		apps = self.executor.loader.project_state(self.before).apps
+		User = apps.get_model('auth', 'User')
+		Profile = apps.get_model('store', 'Profile')
+		Category = apps.get_model('store', 'Category')
+		Product = apps.get_model('store', 'Product')
+		hats = Category.objects.create(name='Hats')
+		fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		beret = Product.objects.create(name='Beret', price=30, category=hats)
+		carts = {
+			'new': json.dumps({
+				str(fedora.pk): {'quantity': 2, 'selected_size': '57', 'custom_size': ''},
+				str(beret.pk): {'quantity': 1, 'selected_size': '', 'custom_size': '58cm'},
+				# Deleted product
+				'99999': {'quantity': 1},
+			}),
+			# Old format: just the quantity
+			'old': json.dumps({str(beret.pk): 3}),
+			# Cut off at 200 characters
+			'truncated': '{"%s": {"quantity": 1, "selec' % fedora.pk,
+		}
+		users = {}
+		for name, old_cart in carts.items():
+			users[name] = User.objects.create(username=name)
+			Profile.objects.create(user=users[name], old_cart=old_cart)
+
+		executor = MigrationExecutor(connection)
+		executor.migrate(self.after)
+		CartLine = executor.loader.project_state(self.after).apps.get_model('cart', 'CartLine')
+		saved = {
+			(line.user_id, line.product_id): (line.quantity, line.selected_size, line.custom_size)
+			for line in CartLine.objects.all()
+		}
+		self.assertEqual(saved, {
+			(users['new'].pk, fedora.pk): (2, '57', ''),
+			(users['new'].pk, beret.pk): (1, '', '58cm'),
+			(users['old'].pk, beret.pk): (3, '', ''),
+		})
+
+
+class LoadSavedCartTests(TestCase):
+	"""Saved CartLine rows come back in the session cart format"""
+	def test_round_trip(self):
+		hats = Category.objects.create(name='Hats')
+		fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		user = User.objects.create_user('buyer')
+		cart = {str(fedora.pk): {'quantity': 2, 'selected_size': '57', 'custom_size': '58cm'}}
+		persist_cart(cart_request(user, dict(cart)))
+		with self.assertNumQueries(1):
+			self.assertEqual(load_saved_cart(user), cart)
+
+
+class LazyCartTests(TestCase):
+	"""The cart context processor only touches the session when used"""
+	def test_unused_cart(self):
+		request = cart_request()
+		context_cart = cart_context(request)['cart']
+		self.assertFalse(request.session.accessed)
+		self.assertEqual(len(context_cart), 0)
+		# Counting does not create an empty cart
+		self.assertNotIn('session_key', request.session)
+
+
+class RestoreSavedCartTests(TestCase):
+	"""Saved carts are merged into the session cart on login"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.fedora = Product.objects.create(name='Fedora', price=50, category=hats)
+		cls.beret = Product.objects.create(name='Beret', price=30, category=hats)
+		cls.user = User.objects.create_user('buyer', password='secret')
+		CartLine.objects.create(user=cls.user, product=cls.fedora, quantity=2, selected_size='57')
+		CartLine.objects.create(user=cls.user, product=cls.beret, quantity=1)
+
+	def session_cart(self):
+		return {str(self.fedora.pk): {'quantity': 1, 'selected_size': '59', 'custom_size': ''}}
+
+	def test_increment(self):
+		cart = Cart(cart_request(self.user, self.session_cart()))
+		self.assertEqual(cart.restore_saved(increment=True), 2)
+		# Quantities add up, the session line keeps its size
+		self.assertEqual(cart.cart[str(self.fedora.pk)], {'quantity': 3, 'selected_size': '59', 'custom_size': ''})
+		self.assertEqual(cart.cart[str(self.beret.pk)]['quantity'], 1)
+
+	def test_keep(self):
+		cart = Cart(cart_request(self.user, self.session_cart()))
+		self.assertEqual(cart.restore_saved(), 1)
+		# Lines already in the cart are left alone
+		self.assertEqual(cart.cart[str(self.fedora.pk)]['quantity'], 1)
+		self.assertEqual(cart.cart[str(self.beret.pk)]['quantity'], 1)
+
+	def test_login_increments(self):
+		session = self.client.session
+		session['session_key'] = self.session_cart()
+		session.save()
+		self.client.post(reverse('login'), {'username': 'buyer', 'password': 'secret'}, secure=True)
+		self.assertEqual(self.client.session['session_key'][str(self.fedora.pk)]['quantity'], 3)
+
+	def test_social_login_restores_once_per_session(self):
+		self.client.force_login(self.user)
+		self.client.get(reverse('about'), secure=True)
+		self.assertEqual(set(self.client.session['session_key']), {str(self.fedora.pk), str(self.beret.pk)})
+		self.assertTrue(self.client.session['cart_restored_from_social'])
+
+		# An emptied cart is not restored again in the same session
+		session = self.client.session
+		session['session_key'] = {}
+		session.save()
+		with mock.patch.object(Cart, 'restore_saved') as restore_saved:
+			self.client.get(reverse('about'), secure=True)
+		restore_saved.assert_not_called()
+		self.assertEqual(self.client.session['session_key'], {})
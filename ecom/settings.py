@@ -77,8 +77,12 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
     'store.social_cart_middleware.SocialLoginCartMiddleware',
+    'cart.middleware.CartPersistenceMiddleware',
 ]
 
+# Save the cart to the user's CartLine rows once per request (see cart.middleware)
+CART_WRITE_BEHIND = True
+
 # ========= TEMPLATES ==========
 ROOT_URLCONF = 'ecom.urls'
 
@@ -146,6 +150,33 @@ MEDIA_URL = '/media/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# ========= CACHE ==========
+# Must be shared by the gunicorn workers and the image worker: the page
+# cache, facets, categories and wishlist counts invalidate each other
+# through version tokens kept in it. Redis when available, otherwise the
+# database (table made by `manage.py createcachetable`). A per-process
+# cache is only for a single process dev server, see store/checks.py.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+elif DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        }
+    }
+
 # ========= ALLAUTH ==========
 LOGIN_REDIRECT_URL = '/'
 ACCOUNT_LOGOUT_REDIRECT_URL = '/'
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.4 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0008_orderitem_custom_size_orderitem_selected_size'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-date_ordered'], name='order_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('shipped', True)), fields=['-date_ordered'], name='order_shipped_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('shipped', False)), fields=['-date_ordered'], name='order_pending_date_idx'),
+        ),
+    ]
@@ -15,6 +15,15 @@ class Order(models.Model):
 	shipped = models.BooleanField(default=False)
 	date_shipped = models.DateTimeField(blank=True, null=True)
 
+	class Meta:
+		indexes = [
+			# A user's orders, newest first
+			models.Index(fields=['user', '-date_ordered'], name='order_user_date_idx'),
+			# Shipped / not shipped dashboards, one small index per status
+			models.Index(fields=['-date_ordered'], condition=models.Q(shipped=True), name='order_shipped_date_idx'),
+			models.Index(fields=['-date_ordered'], condition=models.Q(shipped=False), name='order_pending_date_idx'),
+		]
+
 	def __str__(self):
 		return f'Order - #{self.id}'
 
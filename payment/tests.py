@@ -1,3 +1,42 @@
 from django.test import TestCase
+from django.contrib.auth.models import User
+from store.tests import QueryPlanMixin
+from django.core.paginator import Paginator
+from .models import Order, OrderItem
+from .views import dashboard_orders, items_of, orders_of
 
-# Create your tests here.
+class OrderQueryPlanTests(QueryPlanMixin, TestCase):
+	"""The order queries payment.views runs use an index"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.users = [User.objects.create(username=f'user{i}') for i in range(10)]
+		Order.objects.bulk_create([
+			Order(
+				user=cls.users[i % 10],
+				full_name='Test',
+				email='test@example.com',
+				shipping_address='Street',
+				amount_paid=10,
+				shipped=i % 3 == 0,
+			)
+			for i in range(200)
+		])
+		cls.order = Order.objects.first()
+		OrderItem.objects.bulk_create([OrderItem(order=cls.order, price=10) for _ in range(5)])
+
+	def test_user_orders(self):
+		# The first page, as user_orders' paginator slices it
+		page = Paginator(orders_of(self.users[0]), 10).get_page(1)
+		self.assertUsesIndex(page.object_list)
+
+	def test_user_order_counts(self):
+		self.assertUsesIndex(orders_of(self.users[0]).filter(shipped=False))
+
+	def test_not_shipped_dash(self):
+		self.assertUsesIndex(dashboard_orders(False))
+
+	def test_shipped_dash(self):
+		self.assertUsesIndex(dashboard_orders(True))
+
+	def test_order_items(self):
+		self.assertUsesIndex(items_of(self.order))
@@ -1,10 +1,11 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from cart.cart import Cart
+from cart.models import CartLine
 from payment.forms import ShippingForm, PaymentForm
 from payment.models import ShippingAddress, Order, OrderItem
 from django.contrib.auth.models import User
 from django.contrib import messages
-from store.models import Product, Profile
+from store.models import Product
 import datetime
 from payment.simple_order_email import send_simple_order_email
 
@@ -17,12 +18,24 @@ import uuid # unique user id for duplictate orders
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
 
+def dashboard_orders(shipped):
+	"""Orders for the shipped / not shipped dashboards, newest first"""
+	return Order.objects.filter(shipped=shipped).order_by('-date_ordered')
+
+def orders_of(user):
+	"""A customer's orders, newest first"""
+	return Order.objects.filter(user=user).order_by('-date_ordered')
+
+def items_of(order):
+	"""An order's items"""
+	return OrderItem.objects.filter(order=order)
+
 def orders(request, pk):
 	if request.user.is_authenticated and request.user.is_superuser:
 		# Get the order
 		order = Order.objects.get(id=pk)
 		# Get the order items
-		items = OrderItem.objects.filter(order=pk)
+		items = items_of(pk)
 
 		if request.POST:
 			status = request.POST['shipping_status']
@@ -55,7 +68,7 @@ def orders(request, pk):
 
 def not_shipped_dash(request):
 	if request.user.is_authenticated and request.user.is_superuser:
-		orders = Order.objects.filter(shipped=False)
+		orders = dashboard_orders(False)
 		if request.POST:
 			status = request.POST['shipping_status']
 			num = request.POST['num']
@@ -76,7 +89,7 @@ def not_shipped_dash(request):
 
 def shipped_dash(request):
 	if request.user.is_authenticated and request.user.is_superuser:
-		orders = Order.objects.filter(shipped=True)
+		orders = dashboard_orders(True)
 		if request.POST:
 			status = request.POST['shipping_status']
 			num = request.POST['num']
@@ -100,10 +113,8 @@ def process_order(request):
 	if request.POST:
 		# Get the cart
 		cart = Cart(request)
-		cart_products = cart.get_prods
-		quantities = cart.get_quants
-		cart_details = cart.get_cart_details()  # Get complete cart details with sizes
 		totals = cart.cart_total()
+		priced_lines = cart.get_priced()['lines']
 
 		# Get Billing Info from the last page
 		payment_form = PaymentForm(request.POST or None)
@@ -130,46 +141,29 @@ def process_order(request):
 			# Get the order ID
 			order_id = create_order.pk
 			
-			# Get product Info
-			for product in cart_products():
-				# Get product ID
-				product_id = product.id
-				# Get product price
-				if product.is_sale:
-					price = product.sale_price
-				else:
-					price = product.price
-
-				# Get quantity and size information from cart
-				for key, item_data in cart_details.items():
-					if int(key) == product.id:
-						quantity = item_data['quantity']
-						selected_size = item_data.get('selected_size', '')
-						custom_size = item_data.get('custom_size', '')
-						
-						# Create order item with size information
-						create_order_item = OrderItem(
-							order_id=order_id, 
-							product_id=product_id, 
-							user=user, 
-							quantity=quantity, 
-							price=price,
-							selected_size=selected_size,
-							custom_size=custom_size
-						)
-						create_order_item.save()
+			# Get product, price, quantity and size from the priced cart
+			for line in priced_lines:
+				# Create order item with size information
+				create_order_item = OrderItem(
+					order_id=order_id, 
+					product_id=line['product'].id, 
+					user=user, 
+					quantity=line['quantity'], 
+					price=line['price'],
+					selected_size=line['selected_size'],
+					custom_size=line['custom_size']
+				)
+				create_order_item.save()
 
 			# Delete our cart
 			send_simple_order_email()
 			for key in list(request.session.keys()):
-				if key == "session_key":
+				if key in ("session_key", "saved_cart_digest"):
 					# Delete the key
 					del request.session[key]
 
-			# Delete Cart from Database (old_cart field)
-			current_user = Profile.objects.filter(user__id=request.user.id)
-			# Delete shopping cart in database (old_cart field)
-			current_user.update(old_cart="")
+			# Delete shopping cart in database (CartLine rows)
+			CartLine.objects.filter(user=request.user).delete()
 
 
 			messages.success(request, "Order Placed!")
@@ -188,33 +182,18 @@ def process_order(request):
 			# Get the order ID
 			order_id = create_order.pk
 			
-			# Get product Info
-			for product in cart_products():
-				# Get product ID
-				product_id = product.id
-				# Get product price
-				if product.is_sale:
-					price = product.sale_price
-				else:
-					price = product.price
-
-				# Get quantity and size information from cart
-				for key, item_data in cart_details.items():
-					if int(key) == product.id:
-						quantity = item_data['quantity']
-						selected_size = item_data.get('selected_size', '')
-						custom_size = item_data.get('custom_size', '')
-						
-						# Create order item with size information
-						create_order_item = OrderItem(
-							order_id=order_id, 
-							product_id=product_id, 
-							quantity=quantity, 
-							price=price,
-							selected_size=selected_size,
-							custom_size=custom_size
-						)
-						create_order_item.save()
+			# Get product, price, quantity and size from the priced cart
+			for line in priced_lines:
+				# Create order item with size information
+				create_order_item = OrderItem(
+					order_id=order_id, 
+					product_id=line['product'].id, 
+					quantity=line['quantity'], 
+					price=line['price'],
+					selected_size=line['selected_size'],
+					custom_size=line['custom_size']
+				)
+				create_order_item.save()
 
 			# Delete our cart
 			send_simple_order_email()
@@ -364,7 +343,7 @@ def user_orders(request):
     """
     try:
         # Get user's orders, newest first
-        orders = Order.objects.filter(user=request.user).order_by('-date_ordered')
+        orders = orders_of(request.user)
         
         # Pagination: 10 orders per page
         paginator = Paginator(orders, 10)
@@ -401,7 +380,7 @@ def order_detail(request, order_id):
         order = get_object_or_404(Order, id=order_id, user=request.user)
         
         # Get order items
-        order_items = OrderItem.objects.filter(order=order)
+        order_items = items_of(order)
         
         # Calculate subtotal
         subtotal = sum(item.price * item.quantity for item in order_items)
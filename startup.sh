@@ -5,6 +5,7 @@ echo "🚀 Starting Django application on Railway..."
 
 echo "1. Applying database migrations..."
 python manage.py migrate --noinput
+python manage.py createcachetable
 
 echo "2. Collecting static files..."
 python manage.py collectstatic --noinput --clear
@@ -104,7 +105,12 @@ else:
     print('✅ Google OAuth should work now!')
 "
 
-echo "7. Starting Gunicorn server..."
+echo "7. Starting image worker..."
+python manage.py queue_image_variants
+# Restarted if it ever exits, or the queue stops draining
+(while true; do python manage.py process_image_jobs; sleep 5; done) &
+
+echo "8. Starting Gunicorn server..."
 exec gunicorn ecom.wsgi \
     --bind 0.0.0.0:$PORT \
     --workers 3 \
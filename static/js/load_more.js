@@ -0,0 +1,44 @@
+// Load more product cards into the grid in place of a full page load.
+// Links with data-load-more point at the products_more fragment endpoint,
+// their href stays the normal next page for when the request fails.
+document.addEventListener('click', function(e) {
+  const link = e.target.closest('[data-load-more]');
+  if (!link) {
+    return;
+  }
+  e.preventDefault();
+  if (link.classList.contains('loading')) {
+    return;
+  }
+  link.classList.add('loading');
+
+  fetch(link.dataset.loadMore, { headers: { 'Accept': 'application/json' } })
+    .then(response => {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      return response.json();
+    })
+    .then(data => {
+      const grid = document.querySelector('.products-grid');
+      grid.insertAdjacentHTML('beforeend', data.html);
+
+      if (data.next_cursor) {
+        const moreUrl = new URL(link.dataset.loadMore, window.location.href);
+        moreUrl.searchParams.set('cursor', data.next_cursor);
+        link.dataset.loadMore = moreUrl.pathname + moreUrl.search;
+        const pageUrl = new URL(link.href);
+        pageUrl.searchParams.set('cursor', data.next_cursor);
+        link.href = pageUrl.href;
+        link.classList.remove('loading');
+      } else {
+        link.remove();
+      }
+      // Click handlers on the cards are delegated, this is for anything else
+      // a page wants to do with new cards
+      document.dispatchEvent(new CustomEvent('products:loaded', { detail: { grid: grid } }));
+    })
+    .catch(() => {
+      window.location.href = link.href;
+    });
+});
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Category, Customer, Product, Order, Profile, ContactMessage, HeadSize, Wishlist
+from .models import Category, Customer, Product, Order, Profile, ContactMessage, HeadSize, Wishlist, ImageJob
 from django.contrib.auth.models import User
 
 admin.site.register(Category)
@@ -22,6 +22,12 @@ class ContactMessageAdmin(admin.ModelAdmin):
     list_filter = ('read','created_at')
     search_fields = ('name','email','message')
 
+@admin.register(ImageJob)
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ('model', 'object_id', 'field_name', 'status', 'attempts', 'updated_at')
+    list_filter = ('status', 'model')
+    readonly_fields = ('model', 'object_id', 'field_name', 'source_name', 'attempts', 'error', 'created_at', 'updated_at')
+
 # Mix profile info and user info
 class ProfileInline(admin.StackedInline):
     model = Profile
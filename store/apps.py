@@ -6,3 +6,7 @@ import os
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+
+    def ready(self):
+        # Connect the search index and cache signals
+        from . import checks, search, facets, facet_index, autocomplete, categories, related, page_cache, wishlists, images
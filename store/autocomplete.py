@@ -0,0 +1,137 @@
+# store/autocomplete.py
+"""
+Autocomplete for search_live.
+
+Product and category names are split into words and every word prefix
+is indexed, so a lookup is a few set intersections. Result rows
+(including image URLs) are built once when the index is loaded, and
+responses per normalized query are cached for a short time.
+
+Like the facet index, each worker keeps its own copy and rebuilds when
+the version token in the shared cache changes.
+"""
+import re
+import threading
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from .models import Category, Product
+
+VERSION_CACHE_KEY = 'store:autocomplete:version'
+RESPONSE_CACHE_TIMEOUT = 60
+# Longest indexed prefix, longer words are checked against the names
+MAX_PREFIX = 10
+MAX_PRODUCTS = 8
+MAX_COLLECTIONS = 4
+PLACEHOLDER_IMAGE = '/static/images/placeholder.png'
+
+
+def words(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def normalize(query):
+    return ' '.join(words(query)[:5])
+
+
+class PrefixIndex():
+    """Word prefix -> ids of the entries whose name has such a word"""
+    def __init__(self):
+        self.entries = {}
+        self.prefixes = {}
+
+    def add(self, pk, name, entry):
+        self.entries[pk] = (name.lower(), entry)
+        for word in set(words(name)):
+            for length in range(1, min(len(word), MAX_PREFIX) + 1):
+                self.prefixes.setdefault(word[:length], set()).add(pk)
+
+    def lookup(self, terms, limit):
+        matches = None
+        for term in terms:
+            ids = self.prefixes.get(term[:MAX_PREFIX], set())
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        # Words longer than the indexed prefix need a real check
+        long_terms = [term for term in terms if len(term) > MAX_PREFIX]
+        if long_terms:
+            matches = {
+                pk for pk in matches
+                if all(any(word.startswith(term) for word in words(self.entries[pk][0])) for term in long_terms)
+            }
+        phrase = ' '.join(terms)
+        # Names starting with the query first, then shorter names, then newest
+        ranked = sorted(
+            matches,
+            key=lambda pk: (not self.entries[pk][0].startswith(phrase), len(self.entries[pk][0]), -pk),
+        )
+        return [self.entries[pk][1] for pk in ranked[:limit]]
+
+
+class Autocomplete():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.products = None
+        self.collections = None
+
+    def build(self):
+        version = cache.get(VERSION_CACHE_KEY)
+        products = PrefixIndex()
+        for product in Product.objects.only('id', 'name', 'price', 'image'):
+            products.add(product.id, product.name, {
+                'id': product.id,
+                'name': product.name,
+                'price': f"${product.price}",
+                'image': product.image.url if product.image else PLACEHOLDER_IMAGE,
+            })
+        collections = PrefixIndex()
+        for collection in Category.objects.only('id', 'name', 'slug', 'description', 'image'):
+            collections.add(collection.id, collection.name, {
+                'id': collection.id,
+                'name': collection.name,
+                'slug': collection.slug,
+                'description': collection.description,
+                'image': collection.image.url if collection.image else PLACEHOLDER_IMAGE,
+            })
+        self.products, self.collections, self.version = products, collections, version
+
+    def search(self, query):
+        """Capped product and collection matches for a query, cached per query"""
+        normalized = normalize(query)
+        if not normalized:
+            return {'products': [], 'collections': []}
+
+        version = cache.get(VERSION_CACHE_KEY)
+        cache_key = f'store:autocomplete:{version}:' + normalized.replace(' ', '+')
+        response = cache.get(cache_key)
+        if response is not None:
+            return response
+
+        with self.lock:
+            if self.products is None or self.version != version:
+                self.build()
+        terms = normalized.split()
+        response = {
+            'products': self.products.lookup(terms, MAX_PRODUCTS),
+            'collections': self.collections.lookup(terms, MAX_COLLECTIONS),
+        }
+        cache.set(cache_key, response, RESPONSE_CACHE_TIMEOUT)
+        return response
+
+
+autocomplete = Autocomplete()
+
+
+def invalidate_autocomplete(sender=None, **kwargs):
+    # New version: every worker rebuilds and old cached responses are ignored.
+    # Only once committed, or a worker could rebuild from the old rows
+    transaction.on_commit(lambda: cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, None))
+
+
+post_save.connect(invalidate_autocomplete, sender=Product)
+post_delete.connect(invalidate_autocomplete, sender=Product)
+post_save.connect(invalidate_autocomplete, sender=Category)
+post_delete.connect(invalidate_autocomplete, sender=Category)
@@ -0,0 +1,18 @@
+# store/cards.py
+"""
+The "card" projection of Product used by every product grid.
+
+Cards only show a name, an image, prices and badges, so listings load
+those columns and skip the descriptions, details and extra images.
+"""
+from .models import Product
+
+# Columns used by product_cards.html and the other grid templates
+CARD_FIELDS = ('id', 'name', 'image', 'image_variants', 'price', 'sale_price', 'effective_price', 'is_sale', 'is_unique', 'sold_out')
+
+
+def product_cards(queryset=None, extra_fields=()):
+    """Limit a Product queryset to the card columns (plus any extra ones)"""
+    if queryset is None:
+        queryset = Product.objects.all()
+    return queryset.only(*CARD_FIELDS, *extra_fields)
@@ -0,0 +1,66 @@
+# store/categories.py
+"""
+Cached category lookups.
+
+Every worker keeps the categories (in name order, plus slug and id maps)
+in memory, loaded with one query. Saving or deleting a Category bumps a
+version token in the shared cache, so every worker reloads on its next
+request.
+"""
+import threading
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.utils.text import slugify
+from .models import Category
+
+VERSION_CACHE_KEY = 'store:categories:version'
+
+_lock = threading.Lock()
+_loaded = {'version': None, 'categories': None}
+
+
+def category_map():
+    """{'all': [Category], 'slugs': {slug: Category}, 'ids': {id: Category}}"""
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # First use (or the token was evicted), start a new one
+        cache.add(VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_CACHE_KEY)
+    with _lock:
+        if _loaded['categories'] is None or _loaded['version'] != version:
+            all_categories = list(Category.objects.order_by('name'))
+            _loaded['categories'] = {
+                'all': all_categories,
+                'slugs': {category.slug: category for category in all_categories},
+                'ids': {category.id: category for category in all_categories},
+            }
+            _loaded['version'] = version
+        return _loaded['categories']
+
+
+def all_categories():
+    return category_map()['all']
+
+
+def resolve_category(value):
+    """
+    Find a category from a URL value: an id, a slug, or an old style
+    name link ('Gift Card', 'gift card'). None if nothing matches.
+    """
+    categories = category_map()
+    value = str(value)
+    if value.isdigit() and int(value) in categories['ids']:
+        return categories['ids'][int(value)]
+    return categories['slugs'].get(value) or categories['slugs'].get(slugify(value))
+
+
+def invalidate_category_map(sender=None, **kwargs):
+    # New version: every worker reloads on its next lookup.
+    # Only once committed, or a worker could reload the old rows
+    transaction.on_commit(lambda: cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, None))
+
+
+post_save.connect(invalidate_category_map, sender=Category)
+post_delete.connect(invalidate_category_map, sender=Category)
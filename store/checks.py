@@ -0,0 +1,26 @@
+# store/checks.py
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Caches that are not shared between processes
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def shared_cache_check(app_configs, **kwargs):
+    """
+    Cache invalidation goes through version tokens in the default cache,
+    so with several processes a per-process cache silently serves stale
+    pages and prices.
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.DEBUG or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"The default cache ({backend}) is not shared between processes.",
+        hint="Set REDIS_URL, or use DatabaseCache and run `manage.py createcachetable`.",
+        id='store.E001',
+    )]
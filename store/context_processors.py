@@ -1,25 +1,23 @@
-from .models import Wishlist, Product, Category
+from django.utils.functional import SimpleLazyObject
+from .categories import all_categories
+from .wishlists import request_wishlist_count
 
 def categories(request):
     """
-    Context processor to make categories available in all templates
+    Context processor to make categories available in all templates.
+    Served from the in-memory category list, only loaded when a template uses it.
     """
-    try:
-        return {'categories': Category.objects.all()}
-    except Exception as e:
-        # If there's an error (like database not ready), return empty
-        return {'categories': []}
+    def load():
+        try:
+            return all_categories()
+        except Exception as e:
+            # If there's an error (like database not ready), return empty
+            return []
+    return {'categories': SimpleLazyObject(load)}
 
 def wishlist_count(request):
     """
-    Context processor for wishlist count
+    Context processor for wishlist count.
+    Read-only and cached, only looked up when a template shows it.
     """
-    # Authenticated: count from DB
-    if request.user.is_authenticated:
-        wishlist, _ = Wishlist.objects.get_or_create(user=request.user)
-        count = wishlist.products.count()
-    else:
-        # Guest: count from session
-        product_ids = request.session.get('wishlist', [])
-        count = len(product_ids)
-    return {'wishlist_count': count}
\ No newline at end of file
+    return {'wishlist_count': SimpleLazyObject(lambda: request_wishlist_count(request))}
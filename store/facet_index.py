@@ -0,0 +1,348 @@
+# store/facet_index.py
+"""
+In-process bitmap index for the search filters.
+
+Each facet value (color, material, head size, custom size) keeps one
+Python int used as a bitset over product ids, so combining filters is
+a handful of ANDs and result counts are popcounts.
+
+Every gunicorn worker holds its own index. Changes are applied to the
+local index from signals and a version token in the shared cache is
+bumped, so the other workers notice and rebuild. While an index is
+cold or stale, get_index() returns None and callers use SQL.
+"""
+import bisect
+import threading
+import uuid
+from decimal import Decimal, InvalidOperation
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from .models import HeadSize, Product
+
+VERSION_CACHE_KEY = 'store:facet_index:version'
+
+
+def bits_of(ids):
+    """
+    Bitset with one bit set per id.
+    Set in a byte buffer and converted once: OR-ing the bits into an int
+    one at a time copies the whole int per id.
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for pk in ids:
+        buffer[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def bits_by_value(pairs):
+    """{value: bitset} of (id, value) pairs, each bitset built in one pass"""
+    ids = {}
+    for pk, value in pairs:
+        ids.setdefault(value, []).append(pk)
+    return {value: bits_of(value_ids) for value, value_ids in ids.items()}
+
+
+class BitsetIds():
+    """
+    Ids of a bitset, newest (highest) first.
+    Sliceable and sized, so it can go straight into a Paginator.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self._binary = bin(bits)[2:] if bits else ''
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def before(self, pk):
+        """Ids lower than pk"""
+        # Never build a mask wider than the bitset itself
+        if pk >= self.bits.bit_length():
+            return self
+        return BitsetIds(self.bits & ((1 << max(pk, 0)) - 1))
+
+    def after(self, pk):
+        """Ids higher than pk"""
+        if pk + 1 >= self.bits.bit_length():
+            return BitsetIds(0)
+        return BitsetIds(self.bits >> (max(pk, -1) + 1) << (max(pk, -1) + 1))
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start, stop, _ = item.indices(len(self))
+        ids = []
+        position = -1
+        width = len(self._binary)
+        for index in range(stop):
+            position = self._binary.find('1', position + 1)
+            if index >= start:
+                ids.append(width - 1 - position)
+        return ids
+
+
+class FacetIndex():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.ready = False
+        self.building = False
+        self._reset()
+
+    def _reset(self):
+        self.all = 0
+        self.colors = {}
+        self.materials = {}
+        self.head_sizes = {}
+        self.custom_size = 0
+        # Price of each id, and a bitset per price with the prices sorted,
+        # so a price range is a bisect and an OR of its prices' bitsets
+        self.prices = {}
+        self.price_bits = {}
+        self.sorted_prices = []
+
+    # ---------------- building ----------------
+
+    def build(self):
+        """Load the whole index with two queries"""
+        version = current_version()
+        rows = list(Product.objects.values_list('id', 'color', 'material', 'effective_price', 'allow_custom_size'))
+        head_sizes = self._head_size_bits()
+        all_bits = bits_of(row[0] for row in rows)
+        colors = bits_by_value((row[0], row[1]) for row in rows if row[1])
+        materials = bits_by_value((row[0], row[2]) for row in rows if row[2])
+        custom_size = bits_of(row[0] for row in rows if row[4])
+        prices = {row[0]: row[3] for row in rows}
+        price_bits = bits_by_value(prices.items())
+        with self.lock:
+            self.all = all_bits
+            self.colors = colors
+            self.materials = materials
+            self.head_sizes = head_sizes
+            self.custom_size = custom_size
+            self.prices = prices
+            self.price_bits = price_bits
+            self.sorted_prices = sorted(price_bits)
+            self.version = version
+            self.ready = True
+
+    def _head_size_bits(self):
+        return bits_by_value(Product.head_sizes.through.objects.values_list('product_id', 'headsize_id'))
+
+    def build_in_background(self):
+        if self.building:
+            return
+        self.building = True
+
+        def run():
+            try:
+                self.build()
+            except Exception as e:
+                print(f"Error building facet index: {e}")
+            finally:
+                self.building = False
+                connections.close_all()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _add(self, pk, color, material, price, allow_custom_size):
+        bit = 1 << pk
+        self.all |= bit
+        if color:
+            self.colors[color] = self.colors.get(color, 0) | bit
+        if material:
+            self.materials[material] = self.materials.get(material, 0) | bit
+        if allow_custom_size:
+            self.custom_size |= bit
+        self.prices[pk] = price
+        if price not in self.price_bits:
+            bisect.insort(self.sorted_prices, price)
+        self.price_bits[price] = self.price_bits.get(price, 0) | bit
+
+    def _remove(self, pk, head_sizes=False):
+        mask = ~(1 << pk)
+        self.all &= mask
+        self.custom_size &= mask
+        if pk in self.prices:
+            price = self.prices.pop(pk)
+            self.price_bits[price] &= mask
+            if not self.price_bits[price]:
+                del self.price_bits[price]
+                self.sorted_prices.remove(price)
+        maps = [self.colors, self.materials]
+        if head_sizes:
+            maps.append(self.head_sizes)
+        for values in maps:
+            for value in list(values):
+                values[value] &= mask
+                if not values[value]:
+                    del values[value]
+
+    # ---------------- incremental updates ----------------
+
+    def update_product(self, product):
+        with self.lock:
+            self._remove(product.pk)
+            self._add(product.pk, product.color, product.material, product.effective_price,
+                      product.allow_custom_size)
+
+    def remove_product(self, pk):
+        with self.lock:
+            self._remove(pk, head_sizes=True)
+
+    def reload_head_sizes(self):
+        head_sizes = self._head_size_bits()
+        with self.lock:
+            self.head_sizes = head_sizes
+
+    # ---------------- queries ----------------
+
+    def _price_bits(self, price_min, price_max):
+        if price_min is None and price_max is None:
+            return None
+        start = 0 if price_min is None else bisect.bisect_left(self.sorted_prices, price_min)
+        stop = len(self.sorted_prices) if price_max is None else bisect.bisect_right(self.sorted_prices, price_max)
+        bits = 0
+        for price in self.sorted_prices[start:stop]:
+            bits |= self.price_bits[price]
+        return bits
+
+    def _facet_bits(self, colors=(), materials=(), head_sizes=(), price_min=None, price_max=None,
+                    custom_size=False):
+        """Bitset per active facet, values within a facet are OR-ed"""
+        facet_bits = {}
+        if colors:
+            facet_bits['color'] = bits_of_values(self.colors, colors)
+        if materials:
+            facet_bits['material'] = bits_of_values(self.materials, materials)
+        if head_sizes:
+            facet_bits['head_size'] = bits_of_values(self.head_sizes, head_sizes)
+        price_bits = self._price_bits(price_min, price_max)
+        if price_bits is not None:
+            facet_bits['price'] = price_bits
+        if custom_size:
+            facet_bits['custom_size'] = self.custom_size
+        return facet_bits
+
+    def _combine(self, facet_bits, skip=None):
+        bits = self.all
+        for facet, value_bits in facet_bits.items():
+            if facet != skip:
+                bits &= value_bits
+        return bits
+
+    def match(self, **filters):
+        """Ids of the products matching every filter, newest first"""
+        return BitsetIds(self._combine(self._facet_bits(**filters)))
+
+    def counts(self, **filters):
+        """
+        For every facet value, how many results there would be with that
+        value also ticked (ignoring the other values of the same facet).
+        """
+        facet_bits = self._facet_bits(**filters)
+        counts = {}
+        for facet, values in (('color', self.colors), ('material', self.materials),
+                              ('head_size', self.head_sizes)):
+            base = self._combine(facet_bits, skip=facet)
+            counts[facet] = {value: (base & bits).bit_count() for value, bits in values.items()}
+        counts['custom_size'] = (self._combine(facet_bits, skip='custom_size') & self.custom_size).bit_count()
+        return counts
+
+
+def bits_of_values(values, selected):
+    bits = 0
+    for value in selected:
+        bits |= values.get(value, 0)
+    return bits
+
+
+def parse_filters(params):
+    """Read the search filters from request.GET"""
+    def decimal_or_none(value):
+        try:
+            number = Decimal(value) if value else None
+        except InvalidOperation:
+            return None
+        # NaN and Infinity neither compare nor go in a query
+        return number if number is not None and number.is_finite() else None
+
+    return {
+        'colors': params.getlist('color'),
+        'materials': params.getlist('material'),
+        'head_sizes': [int(pk) for pk in params.getlist('head_size') if pk.isdigit()],
+        'price_min': decimal_or_none(params.get('price_min')),
+        'price_max': decimal_or_none(params.get('price_max')),
+        'custom_size': bool(params.get('custom_size_available')),
+    }
+
+
+def current_version():
+    return cache.get(VERSION_CACHE_KEY)
+
+
+def bump_version():
+    """Tell every worker the catalog changed, and return the new token"""
+    version = uuid.uuid4().hex
+    cache.set(VERSION_CACHE_KEY, version, None)
+    return version
+
+
+index = FacetIndex()
+
+
+def get_index():
+    """
+    The warm, current index of this process, or None.
+    A cold or stale index starts rebuilding in the background.
+    """
+    if index.ready and index.version == current_version():
+        return index
+    index.build_in_background()
+    return None
+
+
+def _apply(change):
+    """
+    Once the transaction commits, apply a change to a current local
+    index, then bump the shared version. Bumping before the commit would
+    let another worker rebuild from the old rows under the new version.
+    """
+    def apply():
+        current = index.ready and index.version == current_version()
+        if current:
+            change()
+        version = bump_version()
+        if current:
+            index.version = version
+    transaction.on_commit(apply)
+
+
+def product_saved(sender, instance, **kwargs):
+    _apply(lambda: index.update_product(instance))
+
+
+def product_deleted(sender, instance, **kwargs):
+    _apply(lambda: index.remove_product(instance.pk))
+
+
+def head_sizes_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _apply(index.reload_head_sizes)
+
+
+def head_size_deleted(sender, instance, **kwargs):
+    def change():
+        with index.lock:
+            index.head_sizes.pop(instance.pk, None)
+    _apply(change)
+
+
+post_save.connect(product_saved, sender=Product)
+post_delete.connect(product_deleted, sender=Product)
+m2m_changed.connect(head_sizes_changed, sender=Product.head_sizes.through)
+post_delete.connect(head_size_deleted, sender=HeadSize)
@@ -0,0 +1,69 @@
+# store/facets.py
+"""
+Facet catalog for the search filter sidebar.
+
+Built once with a handful of aggregate queries and kept in the cache
+until a Product or HeadSize changes.
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from .models import HeadSize, Product
+
+FACET_CACHE_KEY = 'store:facets'
+# Signals do the invalidation, the timeout is only a safety net
+FACET_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _value_counts(field):
+    """Distinct non-empty values of a Product field with their product counts"""
+    rows = (
+        Product.objects.exclude(**{f'{field}__isnull': True}).exclude(**{field: ''})
+        .values(field).annotate(count=Count('id')).order_by(field)
+    )
+    return [{'value': row[field], 'count': row['count']} for row in rows]
+
+
+def build_facets():
+    """Compute every facet from the database"""
+    head_sizes = [
+        {
+            'id': head_size.id,
+            'cm': head_size.cm,
+            'inches': head_size.inches,
+            'standard_size': head_size.standard_size,
+            'count': head_size.product_count,
+        }
+        for head_size in HeadSize.objects.annotate(product_count=Count('product')).order_by('cm')
+    ]
+    prices = Product.objects.aggregate(min_price=Min('effective_price'), max_price=Max('effective_price'))
+    return {
+        'head_sizes': head_sizes,
+        'colors': _value_counts('color'),
+        'materials': _value_counts('material'),
+        'min_price': prices['min_price'] or 0,
+        'max_price': prices['max_price'] or 1000,
+        'custom_size_count': Product.objects.filter(allow_custom_size=True).count(),
+    }
+
+
+def get_facets():
+    """Facet catalog from the cache, rebuilt on a miss"""
+    facets = cache.get(FACET_CACHE_KEY)
+    if facets is None:
+        facets = build_facets()
+        cache.set(FACET_CACHE_KEY, facets, FACET_CACHE_TIMEOUT)
+    return facets
+
+
+def invalidate_facets(sender=None, **kwargs):
+    # After the commit, or a request could cache the old counts again meanwhile
+    transaction.on_commit(lambda: cache.delete(FACET_CACHE_KEY))
+
+
+post_save.connect(invalidate_facets, sender=Product)
+post_delete.connect(invalidate_facets, sender=Product)
+post_save.connect(invalidate_facets, sender=HeadSize)
+post_delete.connect(invalidate_facets, sender=HeadSize)
+m2m_changed.connect(invalidate_facets, sender=Product.head_sizes.through)
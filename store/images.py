@@ -0,0 +1,324 @@
+# store/images.py
+"""
+Background image processing.
+
+Saving a Product or Category stores a new upload as it is and queues an
+ImageJob for it. The process_image_jobs command picks the jobs up,
+makes the compressed JPEG and swaps it into the field, so admin saves
+never wait on Pillow.
+
+Each picture also gets a ladder of responsive variants (see
+make_variants), listed in Model.image_variants and rendered as a
+<picture> srcset by the responsive_image template tag.
+
+Originals are identified by a content hash (Model.image_hashes) and
+every processed result is recorded in ProcessedImage, so a picture is
+processed and uploaded once however often it is saved.
+"""
+import hashlib
+import logging
+import os
+import time
+from datetime import timedelta
+from io import BytesIO
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.utils import timezone
+from PIL import Image
+from .models import MAX_FILE_SIZE, Category, ImageJob, ProcessedImage, Product
+
+try:
+    # Registers AVIF with Pillow versions that cannot write it themselves
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+MAX_DIMENSIONS = (1920, 1920)
+# JPEG quality range of compress_image and its encode budget
+MAX_QUALITY = 85
+MIN_QUALITY = 10
+MAX_ENCODES = 6
+# Decoding an image this large would take over 100MB (after JPEG draft
+# scaling, so camera photos of any size are fine)
+MAX_DECODED_PIXELS = 25 * 1000 * 1000
+# Modes load_image resizes in before converting
+RESIZE_MODES = ('RGB', 'L', 'CMYK')
+MAX_ATTEMPTS = 3
+# A running job not updated for this long lost its worker
+STALE_AFTER = timedelta(minutes=10)
+
+# Widths of the responsive variants, up to MAX_DIMENSIONS
+VARIANT_WIDTHS = (320, 640, 960, 1280, 1920)
+# (extension, Pillow format, content type, save options), best format first.
+# JPEG comes last as it is the <img> fallback every browser can show.
+VARIANT_FORMATS = [
+    ('webp', 'WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', 'image/jpeg', {'quality': 80, 'optimize': True, 'progressive': True}),
+]
+Image.init()
+if 'AVIF' in Image.SAVE:
+    VARIANT_FORMATS.insert(0, ('avif', 'AVIF', 'image/avif', {'quality': 60}))
+
+
+def load_image(data):
+    """
+    Decoded image of some file content, resized to MAX_DIMENSIONS, in L
+    (greyscale) or RGB.
+    JPEGs are decoded straight at the smallest scale (down to 1/8) that
+    still covers MAX_DIMENSIONS, and images are resized before they are
+    converted, so a camera photo is never held in memory at full size.
+    """
+    source = Image.open(BytesIO(data))
+    try:
+        scale = min(MAX_DIMENSIONS[0] / source.width, MAX_DIMENSIONS[1] / source.height)
+        if scale < 1:
+            # The final size, not MAX_DIMENSIONS, or a photo that is not
+            # square only gets scaled down by half
+            source.draft('RGB', (round(source.width * scale), round(source.height * scale)))
+        # The size draft left is the size that will be decoded
+        if source.width * source.height > MAX_DECODED_PIXELS:
+            raise ValueError(f"Image too large to process: {source.width}x{source.height}")
+        if source.mode not in RESIZE_MODES:
+            # Palette images only resize with NEAREST, and resizing with
+            # alpha needs a premultiplied copy bigger than the converted image
+            converted = source.convert('L' if source.mode == 'LA' else 'RGB')
+            source.close()
+            source = converted
+
+        # Resize if too large
+        source.thumbnail(MAX_DIMENSIONS, Image.Resampling.LANCZOS)
+        # Greyscale stays at a third of the size of RGB
+        return source.convert('L' if source.mode == 'L' else 'RGB')
+    finally:
+        # Frees the decoded pixels now rather than whenever it is collected
+        source.close()
+
+
+def compress_image(img):
+    """
+    Compressed JPEG bytes of a loaded image, at the highest quality
+    that fits MAX_FILE_SIZE.
+    Almost every picture fits at MAX_QUALITY with one encode. Larger ones
+    binary search the quality with quick unoptimized trial encodes (an
+    optimized encode is never bigger) and are encoded properly once at
+    the end, with at most MAX_ENCODES encodes in all. An image that does
+    not fit even at MIN_QUALITY is scaled down, and ValueError is raised
+    if that does not fit either.
+    """
+    started = time.monotonic()
+    encodes = 0
+
+    def encode(quality, optimize=True):
+        nonlocal encodes
+        encodes += 1
+        temp_image = BytesIO()
+        img.save(temp_image, format='JPEG', quality=quality, optimize=optimize)
+        return temp_image.getvalue()
+
+    quality = MAX_QUALITY
+    content = encode(quality)
+    if len(content) > MAX_FILE_SIZE:
+        # None until a trial fits, else the lowest quality tried is used
+        quality = None
+        low, high = MIN_QUALITY, MAX_QUALITY - 1
+        # Leaves one encode for the final optimized one and one for the downscale
+        while low <= high and encodes < MAX_ENCODES - 2:
+            middle = (low + high) // 2
+            if len(encode(middle, optimize=False)) <= MAX_FILE_SIZE:
+                quality = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+        if quality is None:
+            # Nothing tried fits, MIN_QUALITY is the last chance at this size
+            quality = MIN_QUALITY
+        content = encode(quality)
+        if len(content) > MAX_FILE_SIZE:
+            # Shrink by the excess (with some slack) and try once more
+            scale = (MAX_FILE_SIZE / len(content)) ** 0.5 * 0.9
+            img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                             Image.Resampling.LANCZOS)
+            content = encode(quality)
+            if len(content) > MAX_FILE_SIZE:
+                raise ValueError(f"Image does not compress under {MAX_FILE_SIZE} bytes")
+
+    logger.info("Compressed %sx%s image to %s bytes at quality %s: %s encodes in %.2fs",
+                img.width, img.height, len(content), quality, encodes, time.monotonic() - started)
+    return content
+
+
+def compress_upload(upload):
+    """An upload too big to store as it is, as a compressed JPEG file"""
+    upload.seek(0)
+    img = load_image(upload.read())
+    name = os.path.splitext(os.path.basename(upload.name))[0] + '.jpg'
+    content = ContentFile(compress_image(img), name=name)
+    img.close()
+    return content
+
+
+def make_variants(img, storage, source_hash):
+    """
+    Save img at every VARIANT_WIDTHS width (never upscaled) in every
+    VARIANT_FORMATS format and return the manifest:
+    {'width': .., 'height': .., 'sources': [{'type': 'image/webp', 'files': [[320, name], ..]}, ..]}
+    """
+    width, height = img.size
+    widths = sorted({min(w, width) for w in VARIANT_WIDTHS}, reverse=True)
+    files = {extension: [] for extension, *_ in VARIANT_FORMATS}
+    resized = img
+    # Each width is resized from the previous, larger one
+    for w in widths:
+        if w != resized.width:
+            resized = resized.resize((w, max(1, round(height * w / width))), Image.Resampling.LANCZOS)
+        for extension, image_format, content_type, options in VARIANT_FORMATS:
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format, **options)
+            name = f'uploads/variants/{source_hash[:2]}/{source_hash}-{w}.{extension}'
+            files[extension].append([w, storage.save(name, ContentFile(buffer.getvalue()))])
+    return {
+        'width': width,
+        'height': height,
+        'sources': [
+            {'type': content_type, 'files': sorted(files[extension])}
+            for extension, image_format, content_type, options in VARIANT_FORMATS
+        ],
+    }
+
+
+# ---------------- queueing ----------------
+
+def queue_new_images(sender, instance, **kwargs):
+    """Queue a job for every image the save just uploaded"""
+    fields = getattr(instance, '_new_images', [])
+    if not fields:
+        return
+    # Compressed on save already, see new_image_fields
+    for field_name in getattr(instance, '_compressed_images', []):
+        ProcessedImage.objects.get_or_create(
+            source_hash=instance.image_hashes[field_name], defaults={'name': getattr(instance, field_name).name})
+    instance._compressed_images = []
+    jobs = [
+        ImageJob(
+            model=instance._meta.label_lower,
+            object_id=instance.pk,
+            field_name=field_name,
+            source_name=getattr(instance, field_name).name,
+        )
+        for field_name in fields
+    ]
+    instance._new_images = []
+    # Only once the row (and the stored original) is committed
+    transaction.on_commit(lambda: ImageJob.objects.bulk_create(jobs))
+
+
+# ---------------- processing ----------------
+
+def claim_jobs(limit):
+    """Mark up to limit pending jobs as running for this worker"""
+    # Jobs left running by a worker that died go back in the queue
+    ImageJob.objects.filter(status=ImageJob.RUNNING, updated_at__lt=timezone.now() - STALE_AFTER).update(
+        status=ImageJob.PENDING, updated_at=timezone.now())
+
+    claimed = []
+    for job in ImageJob.objects.filter(status=ImageJob.PENDING).order_by('created_at')[:limit]:
+        # Another worker may have claimed it in the meantime
+        taken = ImageJob.objects.filter(pk=job.pk, status=ImageJob.PENDING).update(
+            status=ImageJob.RUNNING, attempts=F('attempts') + 1, updated_at=timezone.now())
+        if taken:
+            job.refresh_from_db()
+            claimed.append(job)
+    return claimed
+
+
+def process_image(field, source_hash, processed=None):
+    """
+    Compress the picture in field and make its variants, recording both
+    in ProcessedImage. Given the ProcessedImage of a picture compressed
+    before variants existed, only the variants are made.
+    """
+    with field.storage.open(processed.name if processed else field.name, 'rb') as original:
+        data = original.read()
+    if not source_hash:
+        # Stored before uploads were hashed, when it was compressed on save
+        source_hash = hashlib.sha256(data).hexdigest()
+        processed = ProcessedImage.objects.filter(source_hash=source_hash).first()
+        if processed and processed.variants:
+            return processed
+        processed = processed or ProcessedImage(source_hash=source_hash, name=field.name)
+
+    img = load_image(data)
+    del data
+    if processed is None:
+        name = os.path.splitext(os.path.basename(field.name))[0] + '.jpg'
+        field.save(name, ContentFile(compress_image(img)), save=False)
+        processed = ProcessedImage(source_hash=source_hash, name=field.name)
+
+    variants = make_variants(img, field.storage, source_hash)
+    img.close()
+    # The file the variants belong to, so a replaced image never shows stale ones
+    variants['name'] = processed.name
+    processed, _ = ProcessedImage.objects.update_or_create(
+        source_hash=source_hash, defaults={'name': processed.name, 'variants': variants})
+    return processed
+
+
+def run_job(job):
+    """
+    Process the job's image and swap the result into the field.
+    Returns False when there was nothing left to do.
+    """
+    model = apps.get_model(job.model)
+    instance = model.objects.filter(pk=job.object_id).first()
+    if instance is None:
+        return False
+    field = getattr(instance, job.field_name)
+    # Replaced (or cleared) again since the job was queued
+    if field.name != job.source_name:
+        # The upload was never used, unless it is a processed file others share
+        if not ProcessedImage.objects.filter(name=job.source_name).exists():
+            field.storage.delete(job.source_name)
+        return False
+
+    source_hash = instance.image_hashes.get(job.field_name)
+    processed = ProcessedImage.objects.filter(source_hash=source_hash).first() if source_hash else None
+    # Otherwise the same picture was processed for another job meanwhile
+    if processed is None or not processed.variants:
+        processed = process_image(field, source_hash, processed)
+
+    with transaction.atomic():
+        # Processing took a while: other fields (and their entries in the
+        # JSON columns) may have changed since, so merge into the current row
+        instance = model.objects.select_for_update().filter(pk=job.object_id).first()
+        if instance is None or getattr(instance, job.field_name).name != job.source_name:
+            return False
+        setattr(instance, job.field_name, processed.name)
+        instance.image_hashes[job.field_name] = processed.source_hash
+        instance.image_variants[job.field_name] = processed.variants
+        # A normal save, so the page cache and indexes see the new file
+        instance.save(update_fields=[job.field_name, 'image_hashes', 'image_variants'])
+        if processed.name != job.source_name:
+            # The original upload is superseded once the swap commits
+            transaction.on_commit(lambda: field.storage.delete(job.source_name))
+    return True
+
+
+def process_job(job):
+    try:
+        run_job(job)
+    except Exception as e:
+        logger.exception("Error processing image job %s", job.pk)
+        status = ImageJob.FAILED if job.attempts >= MAX_ATTEMPTS else ImageJob.PENDING
+        ImageJob.objects.filter(pk=job.pk).update(status=status, error=str(e), updated_at=timezone.now())
+        return False
+    ImageJob.objects.filter(pk=job.pk).update(status=ImageJob.DONE, error='', updated_at=timezone.now())
+    return True
+
+
+post_save.connect(queue_new_images, sender=Product)
+post_save.connect(queue_new_images, sender=Category)
@@ -0,0 +1,64 @@
+import multiprocessing
+import resource
+import time
+from io import BytesIO
+from django.core.management.base import BaseCommand
+from PIL import Image
+from store.images import MAX_DIMENSIONS, load_image
+
+
+def decode_full(data):
+    """How images were decoded before load_image"""
+    img = Image.open(BytesIO(data))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail(MAX_DIMENSIONS, Image.Resampling.LANCZOS)
+    return img
+
+
+def measure(decode, data, results):
+    # Runs in a fresh process, so the peak belongs to this decode alone
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.monotonic()
+    img = decode(data)
+    seconds = time.monotonic() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux
+    results.put(((peak - before) / 1024, seconds, img.size, img.mode))
+
+
+class Command(BaseCommand):
+    help = "Compare the peak memory of decoding an upload the old way and with load_image"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help="Image to decode (default: a generated camera-sized JPEG)")
+        parser.add_argument('--megapixels', type=int, default=50, help="Size of the generated JPEG")
+
+    def handle(self, *args, **options):
+        if options['file']:
+            with open(options['file'], 'rb') as f:
+                data = f.read()
+        else:
+            data = self.camera_jpeg(options['megapixels'])
+        with Image.open(BytesIO(data)) as img:
+            self.stdout.write(f"{img.format} {img.width}x{img.height} {img.mode}, {len(data) / 1024 / 1024:.1f}MB")
+
+        context = multiprocessing.get_context('fork')
+        for label, decode in (('before', decode_full), ('after', load_image)):
+            results = context.Queue()
+            process = context.Process(target=measure, args=(decode, data, results))
+            process.start()
+            peak, seconds, size, mode = results.get()
+            process.join()
+            self.stdout.write(f"{label:>6}: peak RSS +{peak:.0f}MB, {seconds:.2f}s -> {size[0]}x{size[1]} {mode}")
+
+    def camera_jpeg(self, megapixels):
+        width = int((megapixels * 1000 * 1000 * 3 / 2) ** 0.5)
+        height = width * 2 // 3
+        # Noise compresses like photo detail, the gradient gives it structure
+        noise = Image.effect_noise((width // 4, height // 4), 40).resize((width, height))
+        img = Image.merge('RGB', (noise, Image.linear_gradient('L').resize((width, height)), noise))
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=90)
+        img.close()
+        return buffer.getvalue()
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from store.models import Product
+from store.related import refresh_related
+
+
+class Command(BaseCommand):
+    help = "Rebuild the precomputed related products of every product"
+
+    def handle(self, *args, **options):
+        products = Product.objects.only('id', 'category_id', 'material', 'color').order_by('id')
+        count = 0
+        links = 0
+        for product in products.iterator():
+            links += refresh_related(product)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Related products built for {count} products ({links} links)"))
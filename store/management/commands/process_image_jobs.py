@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from store.images import claim_jobs, process_job
+from store.related import refresh_queued
+
+
+class Command(BaseCommand):
+    help = ("Process queued product and category images, and queued related product refreshes "
+            "(runs until stopped, or once with --once)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+        parser.add_argument('--batch', type=int, default=10, help="Jobs (and related refreshes) claimed at a time")
+        parser.add_argument('--sleep', type=float, default=5, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            jobs = claim_jobs(options['batch'])
+            for job in jobs:
+                if process_job(job):
+                    self.stdout.write(f"Processed {job}")
+                else:
+                    self.stdout.write(self.style.WARNING(f"Failed {job}"))
+            refreshed = refresh_queued(options['batch'])
+            if refreshed:
+                self.stdout.write(f"Refreshed related products of {refreshed} products")
+            if not jobs and not refreshed:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from store.models import Category, ImageJob, Product
+
+
+class Command(BaseCommand):
+    help = "Queue image jobs for product and category images that have no responsive variants yet"
+
+    def handle(self, *args, **options):
+        queued = set(ImageJob.objects.filter(status__in=[ImageJob.PENDING, ImageJob.RUNNING])
+                     .values_list('model', 'object_id', 'field_name'))
+        jobs = []
+        for model in (Product, Category):
+            label = model._meta.label_lower
+            for instance in model.objects.only('id', 'image_variants', *model.IMAGE_FIELDS).iterator():
+                for field_name in model.IMAGE_FIELDS:
+                    field = getattr(instance, field_name)
+                    manifest = instance.image_variants.get(field_name) or {}
+                    if not field or manifest.get('name') == field.name:
+                        continue
+                    if (label, instance.pk, field_name) in queued:
+                        continue
+                    jobs.append(ImageJob(model=label, object_id=instance.pk, field_name=field_name,
+                                         source_name=field.name))
+        ImageJob.objects.bulk_create(jobs)
+        self.stdout.write(self.style.SUCCESS(f"Queued {len(jobs)} image jobs"))
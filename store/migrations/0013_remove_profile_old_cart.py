@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 05:42
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_remove_product_is_featured'),
+        ('cart', '0002_copy_profile_old_cart'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='profile',
+            name='old_cart',
+        ),
+    ]
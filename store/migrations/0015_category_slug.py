@@ -0,0 +1,40 @@
+# Generated by Django 4.2.4 on 2026-10-18 06:31
+
+from django.db import migrations, models
+from django.utils.text import slugify
+
+
+def fill_slugs(apps, schema_editor):
+    Category = apps.get_model('store', 'Category')
+    taken = set()
+    for category in Category.objects.order_by('id'):
+        base = slugify(category.name) or 'category'
+        slug = base
+        number = 2
+        while slug in taken:
+            slug = f'{base}-{number}'
+            number += 1
+        taken.add(slug)
+        category.slug = slug
+        category.save(update_fields=['slug'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=60, null=True),
+        ),
+        migrations.RunPython(fill_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='category',
+            name='slug',
+            field=models.SlugField(blank=True, max_length=60, unique=True),
+        ),
+    ]
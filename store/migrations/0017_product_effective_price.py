@@ -0,0 +1,28 @@
+# Generated by Django 4.2.4 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Case, F, When
+
+
+def fill_effective_price(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Product.objects.update(effective_price=Case(
+        When(is_sale=True, then=F('sale_price')),
+        default=F('price'),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_relatedproduct'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=6),
+        ),
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedRefresh',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='store.product')),
+                ('queued_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
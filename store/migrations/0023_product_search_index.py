@@ -0,0 +1,39 @@
+# Generated by Django 4.2.4 on 2026-10-18 06:26
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class PostgresAddIndex(migrations.AddIndex):
+    """
+    AddIndex that only creates the index on PostgreSQL (other databases
+    have no GIN indexes). The model state always has it.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        # Databases migrated before the index was declared already have it
+        table = to_state.apps.get_model(app_label, self.model_name)._meta.db_table
+        with schema_editor.connection.cursor() as cursor:
+            existing = schema_editor.connection.introspection.get_constraints(cursor, table)
+        if self.index.name not in existing:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0022_relatedrefresh'),
+    ]
+
+    operations = [
+        PostgresAddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='store_product_search_idx'),
+        ),
+    ]
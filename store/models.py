@@ -1,12 +1,14 @@
 from django.db import models
 import datetime
+import hashlib
+import re
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.utils import timezone
+from django.utils.text import slugify
 from django.conf import settings
-from PIL import Image
-from io import BytesIO
-import cloudinary.uploader
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 
 # Create Customer Profile
@@ -20,7 +22,6 @@ class Profile(models.Model):
     state = models.CharField(max_length=200, blank=True)
     zipcode = models.CharField(max_length=200, blank=True)
     country = models.CharField(max_length=200, blank=True)
-    old_cart = models.CharField(max_length=200, blank=True, null=True)
 
     def __str__(self):
         return self.user.username
@@ -35,61 +36,99 @@ def create_profile(sender, instance, created, **kwargs):
 post_save.connect(create_profile, sender=User)
 
 
+# Uploads are stored as they are up to this size, larger ones are
+# compressed on save to stay under Cloudinary's 10MB limit (with a 1MB buffer)
+MAX_FILE_SIZE = 9 * 1024 * 1024
+
+
+def file_hash(file):
+    """sha256 of a file's content"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def new_image_fields(instance, field_names):
+    """
+    Image fields holding a new upload that needs processing.
+    An upload whose content is already stored, on this object or processed
+    for another one, is pointed at the existing file and variants instead,
+    so it is never decoded, re-encoded or uploaded again (files processed
+    before variants existed are queued once to get them).
+    """
+    instance._compressed_images = []
+    uploads = [name for name in field_names if getattr(instance, name) and not getattr(instance, name)._committed]
+    if not uploads:
+        return []
+    stored = {}
+    if instance.pk:
+        stored = type(instance).objects.filter(pk=instance.pk).values(*uploads).first() or {}
+
+    new = []
+    for name in uploads:
+        content_hash = file_hash(getattr(instance, name))
+        if content_hash == instance.image_hashes.get(name) and stored.get(name):
+            # The same picture uploaded again
+            setattr(instance, name, stored[name])
+            continue
+        instance.image_hashes[name] = content_hash
+        processed = ProcessedImage.objects.filter(source_hash=content_hash).first()
+        if not processed and getattr(instance, name).size > MAX_FILE_SIZE:
+            # Too big to store as it is, so compressed now and the job
+            # only makes its variants
+            from PIL import Image
+            from .images import compress_upload
+            upload = getattr(instance, name)
+            try:
+                setattr(instance, name, compress_upload(upload))
+                instance._compressed_images.append(name)
+            except (ValueError, OSError, Image.DecompressionBombError) as e:
+                # Keep the original, its job processes it (or records the error)
+                print(f"Error compressing image {upload.name}: {e}")
+                upload.seek(0)
+        if processed:
+            setattr(instance, name, processed.name)
+            instance.image_variants[name] = processed.variants
+        if not processed or not processed.variants:
+            new.append(name)
+    return new
+
+
 # Categories of Products
 class Category(models.Model):
     name = models.CharField(max_length=50)
+    slug = models.SlugField(max_length=60, unique=True, blank=True)
     description = models.TextField(blank=True, null=True)
     image = models.ImageField(upload_to='uploads/category/', blank=True, null=True)
+    # Content hash of the original of each image field, see new_image_fields
+    image_hashes = models.JSONField(default=dict, blank=True, editable=False)
+    # Responsive variants of each image field, see store.images.make_variants
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+
+    IMAGE_FIELDS = ('image',)
 
     def save(self, *args, **kwargs):
-        # Check if image is being updated
-        if self.image and hasattr(self.image, 'file'):
-            self.compress_image_before_save()
-        
+        # Keep the slug in step with the name
+        base = slugify(self.name) or 'category'
+        if not self.slug or not re.fullmatch(rf'{re.escape(base)}(-\d+)?', self.slug):
+            self.slug = self.unique_slug(base)
+
+        # A new upload is stored as it is (within MAX_FILE_SIZE), store.images compresses it in the background
+        self._new_images = new_image_fields(self, self.IMAGE_FIELDS)
+
         super().save(*args, **kwargs)
 
-    def compress_image_before_save(self):
-        """Compress image to under 10MB before saving"""
-        try:
-            # Open the uploaded image
-            img = Image.open(self.image.file)
-            
-            # Convert to RGB if necessary
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            
-            # Resize if too large
-            max_size = (1920, 1920)  # Max dimensions
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Compress to reduce file size
-            temp_image = BytesIO()
-            
-            # Start with high quality and reduce until under 9MB
-            quality = 85
-            max_file_size = 9 * 1024 * 1024  # 9MB (leave 1MB buffer)
-            
-            while quality > 10:
-                temp_image.seek(0)
-                temp_image.truncate(0)
-                
-                # Save with current quality
-                img.save(temp_image, format='JPEG', quality=quality, optimize=True)
-                
-                # Check file size
-                if temp_image.tell() <= max_file_size:
-                    break
-                
-                # Reduce quality for next iteration
-                quality -= 15
-            
-            # Replace the image file with compressed version
-            self.image.file = temp_image
-            self.image.file.seek(0)
-            
-        except Exception as e:
-            print(f"Error compressing image: {e}")
-            # Continue with original image if compression fails
+    def unique_slug(self, base):
+        """Slug from the name, with a number added if it is taken"""
+        slug = base
+        others = Category.objects.exclude(pk=self.pk)
+        number = 2
+        while others.filter(slug=slug).exists():
+            slug = f'{base}-{number}'
+            number += 1
+        return slug
 
     def __str__(self):
         return self.name
@@ -133,67 +172,111 @@ class Product(models.Model):
     image = models.ImageField(upload_to='uploads/product/')
     extra_image1 = models.ImageField(upload_to='uploads/product/', blank=True, null=True)
     extra_image2 = models.ImageField(upload_to='uploads/product/', blank=True, null=True)
+    # Content hash of the original of each image field, see new_image_fields
+    image_hashes = models.JSONField(default=dict, blank=True, editable=False)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     is_sale = models.BooleanField(default=False)
     sold_out = models.BooleanField(default=False)
     is_unique = models.BooleanField(default=False)
     head_sizes = models.ManyToManyField(HeadSize, blank=True)
     allow_custom_size = models.BooleanField(default=False)
     sale_price = models.DecimalField(default=0, decimal_places=2, max_digits=6)
+    # Price actually charged (sale_price while on sale), set in save() for filtering and sorting
+    effective_price = models.DecimalField(default=0, decimal_places=2, max_digits=6, db_index=True, editable=False)
+    # Full-text document on PostgreSQL, kept up to date by store.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Category listings, newest first
+            models.Index(fields=['category', '-id'], name='product_category_newest_idx'),
+            # Search filters
+            models.Index(fields=['color'], name='product_color_idx'),
+            models.Index(fields=['material'], name='product_material_idx'),
+            # Sale items, newest first
+            models.Index(fields=['-id'], condition=models.Q(is_sale=True), name='product_on_sale_idx'),
+            # Full-text search (PostgreSQL only, see migration 0023)
+            GinIndex(fields=['search_vector'], name='store_product_search_idx'),
+        ]
+
+    IMAGE_FIELDS = ('image', 'extra_image1', 'extra_image2')
 
     def save(self, *args, **kwargs):
-        # Compress images before saving
-        self.compress_all_images()
+        self.effective_price = self.sale_price if self.is_sale else self.price
+        # New uploads are stored as they are (within MAX_FILE_SIZE), store.images compresses them in the background
+        self._new_images = new_image_fields(self, self.IMAGE_FIELDS)
         super().save(*args, **kwargs)
 
-    def compress_all_images(self):
-        """Compress all product images before upload"""
-        image_fields = [
-            ('image', self.image),
-            ('extra_image1', self.extra_image1),
-            ('extra_image2', self.extra_image2)
+    def __str__(self):
+        return self.name
+
+
+# Precomputed "you may also like" products, see store.related
+class RelatedProduct(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_links')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_to_links')
+    score = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'{self.product} -> {self.related} ({self.score})'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='related_product_pair'),
         ]
-        
-        for field_name, image_field in image_fields:
-            if image_field and hasattr(image_field, 'file'):
-                self.compress_product_image(image_field)
-
-    def compress_product_image(self, image_field):
-        """Compress a single product image"""
-        try:
-            # Open the uploaded image
-            img = Image.open(image_field.file)
-            
-            # Convert to RGB if necessary
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            
-            # Resize if too large
-            max_size = (1920, 1920)
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            # Compress to reduce file size
-            temp_image = BytesIO()
-            
-            quality = 85
-            max_file_size = 9 * 1024 * 1024  # 9MB
-            
-            while quality > 10:
-                temp_image.seek(0)
-                temp_image.truncate(0)
-                
-                img.save(temp_image, format='JPEG', quality=quality, optimize=True)
-                
-                if temp_image.tell() <= max_file_size:
-                    break
-                
-                quality -= 15
-            
-            # Replace the image file
-            image_field.file = temp_image
-            image_field.file.seek(0)
-            
-        except Exception as e:
-            print(f"Error compressing product image: {e}")
+        indexes = [
+            models.Index(fields=['product', '-score'], name='related_product_score_idx'),
+        ]
+
+
+# Products whose related products need recomputing, see store.related
+class RelatedRefresh(models.Model):
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True)
+    queued_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'Refresh related of {self.product_id}'
+
+
+# Queued image processing, see store.images
+class ImageJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    model = models.CharField(max_length=100)  # 'store.product'
+    object_id = models.PositiveBigIntegerField()
+    field_name = models.CharField(max_length=50)
+    # The stored original, the job is dropped if the field has changed since
+    source_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.model} #{self.object_id} {self.field_name} ({self.status})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='image_job_queue_idx'),
+        ]
+
+
+# Processed file for each original image content, so the same picture is only processed once
+class ProcessedImage(models.Model):
+    source_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    variants = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.name
@@ -0,0 +1,162 @@
+# store/page_cache.py
+"""
+Shared full-page cache for the catalog pages.
+
+Pages are cached per URL (query string included). A page is tagged with
+the data it shows ('product:12', 'products', 'categories'...) and every
+tag has a version token in the shared cache that is part of the page
+key. The signals below bump the versions of the tags a change touches,
+so the stale pages are never read again and simply expire.
+
+Pages are the same for every visitor: while rendering a shared page,
+request.shared_page is set and the navbar leaves out the login state
+and the cart/wishlist counts. A small script fills them in from the
+session_state view. Only visits with pending messages skip the cache.
+"""
+import hashlib
+import uuid
+from functools import wraps
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from .models import Category, HeadSize, Product, RelatedProduct
+
+# Purges do the invalidation, the timeout only bounds unused entries
+PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _tag_key(tag):
+    return f'store:page_tag:{tag}'
+
+
+def tag_versions(tags):
+    keys = [_tag_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() keeps a version another worker set in the meantime
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def page_key(request, tags):
+    url = request.build_absolute_uri()
+    versions = ':'.join(str(version) for version in tag_versions(tags))
+    return 'store:page:' + hashlib.md5(f'{url}|{versions}'.encode()).hexdigest()
+
+
+def purge(*tags):
+    """Drop every cached page showing one of the tags, once the change is committed"""
+    def bump():
+        cache.set_many({_tag_key(tag): uuid.uuid4().hex for tag in tags}, None)
+    transaction.on_commit(bump)
+
+
+def is_cacheable(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    # Messages are rendered into the page
+    return not len(get_messages(request))
+
+
+def cache_shared_page(tags=None):
+    """
+    Cache a view's page for every visitor. tags(request, *args, **kwargs)
+    gives the tags of the page, or None to not cache it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if not is_cacheable(request):
+                return view(request, *args, **kwargs)
+            page_tags = tags(request, *args, **kwargs) if tags else []
+            if page_tags is None:
+                return view(request, *args, **kwargs)
+
+            key = page_key(request, page_tags)
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                request.shared_page = True
+                response = view(request, *args, **kwargs)
+                # Pages embedding this visitor's CSRF token or setting cookies are not shared
+                if (response.status_code == 200 and not response.cookies
+                        and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+                    cache.set(key, (response.content, response['Content-Type']), PAGE_CACHE_TIMEOUT)
+            # Cached pages read the CSRF token from its cookie, so make sure it is set
+            get_token(request)
+            return response
+        return wrapped
+    return decorator
+
+
+# ---------------- purging ----------------
+
+def _linking_products(pk):
+    """Tags of the product pages showing this product as related"""
+    return {f'product:{linker}' for linker in
+            RelatedProduct.objects.filter(related_id=pk).values_list('product_id', flat=True)}
+
+
+def product_saved(sender, instance, **kwargs):
+    tags = {'products', f'product:{instance.pk}', f'products:category:{instance.category_id}'}
+    # The old category's listing loses the product (see related.product_saving)
+    old_category_id = (getattr(instance, '_related_before', None) or (None,))[0]
+    if old_category_id:
+        tags.add(f'products:category:{old_category_id}')
+    tags |= _linking_products(instance.pk)
+    purge(*tags)
+
+
+def product_deleting(sender, instance, **kwargs):
+    # The related links are deleted with the product, read them first
+    instance._page_cache_tags = _linking_products(instance.pk)
+
+
+def product_deleted(sender, instance, **kwargs):
+    tags = {'products', f'product:{instance.pk}', f'products:category:{instance.category_id}'}
+    purge(*tags | getattr(instance, '_page_cache_tags', set()))
+
+
+def head_sizes_changed(sender, instance, action, reverse, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        purge('head_sizes' if reverse else f'product:{instance.pk}')
+
+
+def head_size_changed(sender, instance, **kwargs):
+    purge('head_sizes')
+
+
+def _category_tags(category):
+    # Product pages show their category's name and link
+    return {'categories', f'category:{category.pk}'} | {
+        f'product:{pk}' for pk in Product.objects.filter(category=category).values_list('id', flat=True)}
+
+
+def category_saved(sender, instance, **kwargs):
+    purge(*_category_tags(instance))
+
+
+def category_deleting(sender, instance, **kwargs):
+    instance._page_cache_tags = _category_tags(instance)
+
+
+def category_deleted(sender, instance, **kwargs):
+    purge('products', *getattr(instance, '_page_cache_tags', {'categories'}))
+
+
+post_save.connect(product_saved, sender=Product)
+pre_delete.connect(product_deleting, sender=Product)
+post_delete.connect(product_deleted, sender=Product)
+m2m_changed.connect(head_sizes_changed, sender=Product.head_sizes.through)
+post_save.connect(head_size_changed, sender=HeadSize)
+post_delete.connect(head_size_changed, sender=HeadSize)
+post_save.connect(category_saved, sender=Category)
+pre_delete.connect(category_deleting, sender=Category)
+post_delete.connect(category_deleted, sender=Category)
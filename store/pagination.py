@@ -0,0 +1,225 @@
+# store/pagination.py
+"""
+Keyset (cursor) pagination.
+
+Instead of COUNT(*) plus OFFSET, a page is fetched with a WHERE on the
+sort key of the last row seen, so every page costs the same as the
+first. Cursors are opaque url-safe tokens holding the sort key values
+and a direction. A cursor that does not fit the ordering raises
+InvalidCursor, which Django answers with a 400.
+"""
+import base64
+import hashlib
+import json
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousOperation, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import Q
+
+APPROXIMATE_TOTAL_CACHE_TIMEOUT = 60 * 5
+
+
+class InvalidCursor(SuspiciousOperation):
+    """A ?cursor= that was not made by encode_cursor for this listing"""
+
+
+class KeysetPage():
+    """A page of results with next/previous cursors, used like a Page in templates"""
+    is_keyset = True
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor=None, previous_cursor=None,
+                 approximate_total=None):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.approximate_total = approximate_total
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+
+def encode_cursor(values, direction):
+    payload = json.dumps({'k': values, 'd': direction}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """(direction, values) from a cursor, ('n', None) for the first page"""
+    if not token:
+        return 'n', None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        direction = payload['d']
+        values = payload['k']
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor("Malformed cursor")
+    if direction not in ('n', 'p') or not isinstance(values, list):
+        raise InvalidCursor("Malformed cursor")
+    # Only plain JSON scalars, never null, lists or objects
+    if not all(isinstance(value, (str, int, float)) and not isinstance(value, bool) for value in values):
+        raise InvalidCursor("Malformed cursor values")
+    return direction, values
+
+
+def _keys(ordering):
+    return [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+
+def _cursor_values(model, keys, values):
+    """The cursor values converted to the types of their ordering fields"""
+    if len(values) != len(keys):
+        raise InvalidCursor("Cursor does not match the ordering")
+    converted = []
+    for (field, _), value in zip(keys, values):
+        model_field = model._meta.get_field(field)
+        try:
+            value = model_field.to_python(value)
+            # Range and digit limits, so the value also fits the column
+            model_field.run_validators(value)
+            if isinstance(value, Decimal) and not value.is_finite():
+                raise ValueError(value)
+            # SQLite reports no integer range, but still only takes 64 bits
+            if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+                raise ValueError(value)
+            converted.append(value)
+        except (ValidationError, TypeError, ValueError, ArithmeticError):
+            raise InvalidCursor(f"Bad cursor value for {field}")
+    return converted
+
+
+def _beyond(keys, values, backwards):
+    """Rows after the cursor in the sort order (before it when going backwards)"""
+    condition = Q()
+    equal = Q()
+    for (field, descending), value in zip(keys, values):
+        # Descending keys continue with smaller values
+        smaller = descending != backwards
+        condition |= equal & Q(**{f'{field}__lt' if smaller else f'{field}__gt': value})
+        equal &= Q(**{field: value})
+    return condition
+
+
+def approximate_count(queryset):
+    """
+    Row count for display. PostgreSQL's planner estimate for a whole table,
+    otherwise an exact count cached for a few minutes.
+    """
+    if connection.vendor == 'postgresql' and not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] > 0:
+            return row[0]
+    cache_key = 'store:count:' + hashlib.md5(str(queryset.query).encode()).hexdigest()
+    total = cache.get(cache_key)
+    if total is None:
+        total = queryset.count()
+        cache.set(cache_key, total, APPROXIMATE_TOTAL_CACHE_TIMEOUT)
+    return total
+
+
+def keyset_queryset(queryset, cursor, per_page, ordering=('-id',)):
+    """
+    The query keyset_paginate runs for a page: the rows beyond the cursor
+    in order (reversed going backwards), plus one to tell if there are more.
+    """
+    keys = _keys(ordering)
+    direction, values = decode_cursor(cursor)
+    backwards = direction == 'p'
+
+    page = queryset
+    if values is not None:
+        page = page.filter(_beyond(keys, _cursor_values(queryset.model, keys, values), backwards))
+    if backwards:
+        page = page.order_by(*[field if descending else f'-{field}' for field, descending in keys])
+    else:
+        page = page.order_by(*ordering)
+    return page[:per_page + 1]
+
+
+def keyset_paginate(queryset, cursor, per_page, ordering=('-id',), approximate_total=False):
+    """
+    One page of a queryset after (or before) the cursor.
+    The ordering must end in a unique field so every row has its own key.
+    """
+    keys = _keys(ordering)
+    direction, values = decode_cursor(cursor)
+    backwards = direction == 'p'
+    rows = list(keyset_queryset(queryset, cursor, per_page, ordering))
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, values is not None
+
+    def key_of(row):
+        return [getattr(row, field) for field, _ in keys]
+
+    return KeysetPage(
+        rows,
+        has_next=has_next and bool(rows),
+        has_previous=has_previous and bool(rows),
+        next_cursor=encode_cursor(key_of(rows[-1]), 'n') if rows and has_next else None,
+        previous_cursor=encode_cursor(key_of(rows[0]), 'p') if rows and has_previous else None,
+        approximate_total=approximate_count(queryset) if approximate_total else None,
+    )
+
+
+def keyset_paginate_ids(ids, cursor, per_page, max_id):
+    """
+    Keyset pagination over BitsetIds (newest first), from the facet index.
+    The page's object_list holds product ids, and the total is exact.
+    max_id bounds the cursor's id (the highest id in the index), as ids
+    are bit positions.
+    """
+    direction, values = decode_cursor(cursor)
+    pivot = None
+    if values is not None:
+        if len(values) != 1 or not str(values[0]).isdigit():
+            raise InvalidCursor("Bad cursor id")
+        pivot = int(values[0])
+        if pivot > max_id:
+            raise InvalidCursor("Cursor id out of range")
+    backwards = direction == 'p' and pivot is not None
+
+    remaining = ids
+    if pivot is not None:
+        remaining = ids.after(pivot) if backwards else ids.before(pivot)
+    count = len(remaining)
+    if backwards:
+        page_ids = remaining[max(count - per_page, 0):count]
+        has_next, has_previous = True, count > per_page
+    else:
+        page_ids = remaining[:per_page]
+        has_next, has_previous = count > per_page, pivot is not None
+
+    return KeysetPage(
+        page_ids,
+        has_next=has_next and bool(page_ids),
+        has_previous=has_previous and bool(page_ids),
+        next_cursor=encode_cursor([page_ids[-1]], 'n') if page_ids and has_next else None,
+        previous_cursor=encode_cursor([page_ids[0]], 'p') if page_ids and has_previous else None,
+        approximate_total=len(ids),
+    )
@@ -0,0 +1,158 @@
+# store/related.py
+"""
+Related products for the product page.
+
+Each product's best matches are scored and stored in RelatedProduct:
+same category, same material, same color, and how often the two were
+bought in the same order. The build_related_products command fills
+the whole table. Saves that change what a product is matched on queue
+the affected products in RelatedRefresh, which the background worker
+(process_image_jobs) works through, so admin saves and page views never
+score anything.
+"""
+import heapq
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.signals import post_save, pre_save
+from .cards import product_cards
+from .models import Product, RelatedProduct, RelatedRefresh
+from .page_cache import purge
+
+# How many related products are stored per product
+RELATED_LIMIT = 8
+# Only the newest matches are scored for very large categories
+MAX_CANDIDATES = 500
+
+CATEGORY_SCORE = 3
+MATERIAL_SCORE = 2
+COLOR_SCORE = 1
+# Per order containing both products
+CO_PURCHASE_SCORE = 2
+# What products are matched on, other saves leave related products alone
+SIMILARITY_FIELDS = ('category', 'category_id', 'material', 'color')
+
+
+def similar_products(product):
+    """The newest products sharing a category, material or color with product"""
+    similar = Q(category_id=product.category_id)
+    if product.material:
+        similar |= Q(material=product.material)
+    if product.color:
+        similar |= Q(color=product.color)
+    return Product.objects.filter(similar).exclude(pk=product.pk).order_by('-id')
+
+
+def score_related(product):
+    """Best related products for a product as (product id, score) pairs"""
+    candidates = similar_products(product).values_list('id', 'category_id', 'material', 'color')[:MAX_CANDIDATES]
+
+    scores = {}
+    for pk, category_id, material, color in candidates:
+        score = 0
+        if category_id == product.category_id:
+            score += CATEGORY_SCORE
+        if product.material and material == product.material:
+            score += MATERIAL_SCORE
+        if product.color and color == product.color:
+            score += COLOR_SCORE
+        scores[pk] = score
+
+    # Bought together (payment depends on store, so look the model up lazily)
+    OrderItem = apps.get_model('payment', 'OrderItem')
+    orders = OrderItem.objects.filter(product=product).values('order_id')
+    bought_together = (
+        OrderItem.objects.filter(order_id__in=orders).exclude(product_id=product.pk)
+        .exclude(product_id__isnull=True)
+        .values('product_id').annotate(orders=Count('order_id', distinct=True))
+    )
+    for row in bought_together:
+        scores[row['product_id']] = scores.get(row['product_id'], 0) + CO_PURCHASE_SCORE * row['orders']
+
+    return heapq.nlargest(RELATED_LIMIT, scores.items(), key=lambda item: (item[1], item[0]))
+
+
+def refresh_related(product):
+    """Recompute and store the related products of one product"""
+    links = [
+        RelatedProduct(product_id=product.pk, related_id=pk, score=score)
+        for pk, score in score_related(product)
+    ]
+    with transaction.atomic():
+        RelatedProduct.objects.filter(product_id=product.pk).delete()
+        RelatedProduct.objects.bulk_create(links)
+        # The product page shows the related cards
+        purge(f'product:{product.pk}')
+    return len(links)
+
+
+def related_products_for(product, limit=4):
+    """
+    Related product cards for the product page, in one query.
+    Read only: rows come from saves and build_related_products.
+    """
+    return list(product_cards(
+        Product.objects.filter(related_to_links__product=product)
+        .order_by('-related_to_links__score', '-id')
+    )[:limit])
+
+
+def queue_refresh(product_ids):
+    """Queue products for refresh_queued once the current transaction commits"""
+    rows = [RelatedRefresh(product_id=pk) for pk in set(product_ids)]
+    if rows:
+        # Already queued products keep their place, so repeated saves coalesce
+        transaction.on_commit(lambda: RelatedRefresh.objects.bulk_create(rows, ignore_conflicts=True))
+
+
+def refresh_queued(limit):
+    """Refresh up to limit queued products, oldest first. Returns how many were refreshed."""
+    refreshed = 0
+    for pk in RelatedRefresh.objects.order_by('queued_at').values_list('product_id', flat=True)[:limit]:
+        # Claimed by deleting it: another worker got it first when nothing
+        # is deleted, and a save during the refresh queues it again
+        if not RelatedRefresh.objects.filter(product_id=pk).delete()[0]:
+            continue
+        product = Product.objects.filter(pk=pk).only('id', 'category_id', 'material', 'color').first()
+        if product:
+            refresh_related(product)
+            refreshed += 1
+    return refreshed
+
+
+def _similarity(product):
+    return product.category_id, product.material, product.color
+
+
+def product_saving(sender, instance, update_fields=None, **kwargs):
+    """
+    Remember what the product was matched on before the save. The page
+    cache reads the old category from it too.
+    """
+    if not instance.pk:
+        return
+    if update_fields is not None and not set(update_fields) & set(SIMILARITY_FIELDS):
+        return
+    instance._related_before = (
+        Product.objects.filter(pk=instance.pk).values_list('category_id', 'material', 'color').first())
+
+
+def product_saved(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """Queue the products whose related lists the save may change"""
+    if raw:
+        return
+    if update_fields is not None and not set(update_fields) & set(SIMILARITY_FIELDS):
+        return
+    if not created and getattr(instance, '_related_before', None) == _similarity(instance):
+        # Price, stock, sale and image changes don't affect the matching
+        return
+    # The product itself, the products listing it, and the ones it may now
+    # belong in (a new product is in nobody's list yet)
+    ids = {instance.pk}
+    ids |= set(RelatedProduct.objects.filter(related_id=instance.pk).values_list('product_id', flat=True))
+    ids |= set(similar_products(instance).values_list('id', flat=True)[:MAX_CANDIDATES])
+    queue_refresh(ids)
+
+
+pre_save.connect(product_saving, sender=Product)
+post_save.connect(product_saved, sender=Product)
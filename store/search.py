@@ -0,0 +1,116 @@
+# store/search.py
+"""
+Full-text product search.
+
+PostgreSQL uses the stored Product.search_vector column with a GIN
+index, SQLite uses the store_product_fts FTS5 table. Both are kept up
+to date by the signals below. Any other database falls back to
+icontains.
+"""
+import re
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, IntegerField, Q, When
+from django.db.models.signals import post_delete, post_save
+from .models import Product
+
+FTS_TABLE = 'store_product_fts'
+# SQLite ranks are applied through a CASE over the matched ids, so cap them
+MAX_FTS_RESULTS = 300
+# Ignore anything past this many words
+MAX_TERMS = 8
+
+# FTS5 table lookups, per database name
+_fts_available = {}
+
+
+def search_terms(query):
+    """Split a query into lowercase words, dropping punctuation"""
+    return re.findall(r'\w+', (query or '').lower())[:MAX_TERMS]
+
+
+def product_vector():
+    """Weighted search document for a product: name first, then description"""
+    return (
+        SearchVector('name', weight='A', config='english')
+        + SearchVector('description', weight='B', config='english')
+    )
+
+
+def backend():
+    """Which full-text backend the current database supports"""
+    if connection.vendor == 'postgresql':
+        return 'postgresql'
+    if connection.vendor == 'sqlite':
+        name = connection.settings_dict['NAME']
+        if name not in _fts_available:
+            _fts_available[name] = FTS_TABLE in connection.introspection.table_names()
+        if _fts_available[name]:
+            return 'fts5'
+    return None
+
+
+def search_products(query, queryset=None):
+    """
+    Filter products matching every word of the query (as prefixes),
+    best matches first.
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    terms = search_terms(query)
+    if not terms:
+        return queryset
+
+    engine = backend()
+    if engine == 'postgresql':
+        search_query = SearchQuery(
+            ' & '.join(f'{term}:*' for term in terms), search_type='raw', config='english')
+        return queryset.filter(search_vector=search_query).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank', '-id')
+
+    if engine == 'fts5':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, 10.0, 1.0) LIMIT %s",
+                [match, MAX_FTS_RESULTS],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return queryset.none()
+        ranking = Case(*[When(id=pk, then=position) for position, pk in enumerate(ids)],
+                       output_field=IntegerField())
+        return queryset.filter(id__in=ids).annotate(rank=ranking).order_by('rank')
+
+    # No full-text support, plain substring match
+    condition = Q()
+    for term in terms:
+        condition &= Q(name__icontains=term) | Q(description__icontains=term)
+    return queryset.filter(condition).order_by('-id')
+
+
+def update_search_index(sender, instance, **kwargs):
+    """Re-index a product after it is saved"""
+    engine = backend()
+    if engine == 'postgresql':
+        Product.objects.filter(pk=instance.pk).update(search_vector=product_vector())
+    elif engine == 'fts5':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+                [instance.pk, instance.name or '', instance.description or ''],
+            )
+
+
+def remove_search_index(sender, instance, **kwargs):
+    """Drop a deleted product from the index (PostgreSQL drops it with the row)"""
+    if backend() == 'fts5':
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+
+
+post_save.connect(update_search_index, sender=Product)
+post_delete.connect(remove_search_index, sender=Product)
@@ -0,0 +1,51 @@
+from django import template
+from django.forms.utils import flatatt
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def query_with(context, **changes):
+    """
+    The current query string with some parameters replaced.
+    A value of None removes the parameter:
+    {% query_with cursor=page_obj.next_cursor page=None %}
+    """
+    params = context['request'].GET.copy()
+    for key, value in changes.items():
+        params.pop(key, None)
+        if value is not None:
+            params[key] = value
+    return params.urlencode()
+
+
+# Product grids show two cards a row on phones and four on desktops
+GRID_SIZES = '(max-width: 576px) 50vw, (max-width: 992px) 33vw, 25vw'
+
+
+@register.simple_tag
+def responsive_image(instance, field_name='image', sizes=GRID_SIZES, **attrs):
+    """
+    A <picture> offering the variants of an image field (see
+    store.images.make_variants), or a plain <img> until they are made:
+    {% responsive_image product alt=product.name loading="lazy" %}
+    Nothing for an empty field (categories may have no image).
+    """
+    field = getattr(instance, field_name)
+    if not field:
+        return ''
+    manifest = instance.image_variants.get(field_name)
+    if not manifest or manifest.get('name') != field.name:
+        return format_html('<img src="{}"{}>', field.url, flatatt(attrs))
+
+    def srcset(files):
+        return ', '.join(f'{field.storage.url(name)} {width}w' for width, name in files)
+
+    *sources, fallback = manifest['sources']
+    html = [format_html('<source type="{}" srcset="{}" sizes="{}">', source['type'], srcset(source['files']), sizes)
+            for source in sources]
+    html.append(format_html('<img src="{}" srcset="{}" sizes="{}"{}>',
+                            field.url, srcset(fallback['files']), sizes, flatatt(attrs)))
+    return format_html('<picture>{}</picture>', mark_safe(''.join(html)))
@@ -1,18 +1,759 @@
-from django.test import TestCase
-
-# Create your tests here.
-# store/views.py - Add this for testing
-def test_cart_restoration(request):
-    """Test view to check cart restoration status"""
-    if request.user.is_authenticated:
-        try:
-            profile = Profile.objects.get(user=request.user)
-            return JsonResponse({
-                'user': request.user.username,
-                'saved_cart': profile.old_cart,
-                'session_cart': request.session.get('session_key', {}),
-                'cart_restored': request.session.get('cart_restored_from_social', False)
-            })
-        except Profile.DoesNotExist:
-            return JsonResponse({'error': 'No profile'})
-    return JsonResponse({'error': 'Not authenticated'})
\ No newline at end of file
+import re
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import QueryDict
+from django.urls import reverse
+from PIL import Image
+from . import images
+from .autocomplete import VERSION_CACHE_KEY as AUTOCOMPLETE_VERSION_KEY
+from .categories import VERSION_CACHE_KEY as CATEGORY_VERSION_KEY
+from .facet_index import BitsetIds, FacetIndex, bits_of, current_version, parse_filters
+from .facets import FACET_CACHE_KEY, get_facets
+from .models import Category, HeadSize, ImageJob, Product, Wishlist
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_paginate, keyset_paginate_ids, keyset_queryset
+from .related import refresh_related
+from .search import backend, search_products
+from .templatetags.store_tags import responsive_image
+from .views import SEARCH_ORDERINGS, category_products, newest_products, search_queryset
+from .wishlists import wishlist_count_for
+
+class QueryPlanMixin():
+	"""
+	EXPLAIN a queryset and fail when the plan reads a whole table instead
+	of using an index.
+	Tests build their querysets with the helpers the views use, so they
+	check the queries that actually run.
+	"""
+	def assertUsesIndex(self, queryset):
+		if connection.vendor == 'postgresql':
+			# Tiny test tables are cheaper to scan, so only allow index plans
+			with connection.cursor() as cursor:
+				cursor.execute("SET enable_seqscan = off")
+			plan = queryset.explain()
+			self.assertNotIn('Seq Scan', plan, f"Sequential scan for {queryset.query}:\n{plan}")
+		else:
+			# SQLite: SEARCH uses an index, a bare SCAN reads every row
+			plan = queryset.explain()
+			if self.walks_primary_key(queryset, plan):
+				return
+			full_scans = [line for line in plan.splitlines() if ' SCAN ' in f' {line} ' and 'INDEX' not in line]
+			self.assertFalse(full_scans, f"Full table scan for {queryset.query}:\n{plan}")
+
+	def walks_primary_key(self, queryset, plan):
+		"""
+		A SQLite table is stored in primary key order, so a SCAN in that
+		order which stops at a LIMIT reads only the rows it returns (plus
+		any the filters skip), like PostgreSQL's "Index Scan Backward using
+		..._pkey". Without the LIMIT, or with a sort, it reads every row.
+		"""
+		ordering = queryset.query.order_by or queryset.model._meta.ordering
+		return (queryset.query.high_mark is not None and len(ordering) > 0
+				and ordering[0].lstrip('-') in ('pk', queryset.model._meta.pk.name)
+				and 'USE TEMP B-TREE' not in plan)
+
+class ProductQueryPlanTests(QueryPlanMixin, TestCase):
+	"""The product listings the store views run use an index"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.hats = Category.objects.create(name='Hats')
+		cls.gifts = Category.objects.create(name='Gifts')
+		Product.objects.bulk_create([
+			Product(
+				name=f'Product {i}',
+				price=10 + i,
+				effective_price=10 + i,
+				category=cls.hats if i % 2 else cls.gifts,
+				color=['Black', 'Red', 'Beige'][i % 3],
+				material=['Wool', 'Felt'][i % 2],
+				is_sale=i % 5 == 0,
+			)
+			for i in range(200)
+		])
+		cls.middle = encode_cursor([Product.objects.order_by('id')[100].id], 'n')
+
+	def test_home_listing(self):
+		self.assertUsesIndex(keyset_queryset(newest_products(), None, 8))
+
+	def test_home_listing_next_page(self):
+		self.assertUsesIndex(keyset_queryset(newest_products(), self.middle, 8))
+
+	def test_home_listing_previous_page(self):
+		previous = encode_cursor(decode_cursor(self.middle)[1], 'p')
+		self.assertUsesIndex(keyset_queryset(newest_products(), previous, 8))
+
+	def test_category_listing(self):
+		self.assertUsesIndex(keyset_queryset(category_products(self.hats), None, 4))
+
+	def test_category_listing_next_page(self):
+		self.assertUsesIndex(keyset_queryset(category_products(self.hats), self.middle, 4))
+
+	def test_color_filter(self):
+		self.assertUsesIndex(keyset_queryset(search_queryset(QueryDict('color=Black&color=Red')), None, 8))
+
+	def test_material_filter(self):
+		self.assertUsesIndex(keyset_queryset(search_queryset(QueryDict('material=Wool')), None, 8))
+
+	def test_price_min(self):
+		self.assertUsesIndex(keyset_queryset(search_queryset(QueryDict('price_min=20')), None, 8))
+
+	def test_price_range(self):
+		self.assertUsesIndex(keyset_queryset(
+			search_queryset(QueryDict('price_min=20&price_max=50')), None, 8))
+
+	def test_price_sort(self):
+		params = QueryDict('sort=price_asc&price_min=20&price_max=50')
+		self.assertUsesIndex(keyset_queryset(
+			search_queryset(params), None, 8, ordering=SEARCH_ORDERINGS['price_asc']))
+
+	def test_price_sort_next_page(self):
+		params = QueryDict('sort=price_desc')
+		cursor = encode_cursor(['60.00', 50], 'n')
+		self.assertUsesIndex(keyset_queryset(
+			search_queryset(params), cursor, 8, ordering=SEARCH_ORDERINGS['price_desc']))
+
+class CursorTests(TestCase):
+	"""Keyset pagination round trips, and bad cursors are a 400 rather than a 500"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.category = Category.objects.create(name='Hats')
+		Product.objects.bulk_create([
+			Product(name=f'Product {i}', price=10 + i, effective_price=10 + i, category=cls.category)
+			for i in range(10)
+		])
+		cls.ids = list(Product.objects.order_by('-id').values_list('id', flat=True))
+
+	def test_round_trip(self):
+		seen = []
+		cursor = None
+		while True:
+			page = keyset_paginate(Product.objects.all(), cursor, 3)
+			seen += [product.id for product in page]
+			if not page.has_next():
+				break
+			cursor = page.next_cursor
+		self.assertEqual(seen, self.ids)
+
+		second = keyset_paginate(Product.objects.all(), keyset_paginate(Product.objects.all(), None, 3).next_cursor, 3)
+		first = keyset_paginate(Product.objects.all(), second.previous_cursor, 3)
+		self.assertEqual([product.id for product in first], self.ids[:3])
+		self.assertFalse(first.has_previous())
+
+	def test_round_trip_ids(self):
+		ids = BitsetIds(bits_of(self.ids))
+		seen = []
+		cursor = None
+		while True:
+			page = keyset_paginate_ids(ids, cursor, 4, max(self.ids))
+			seen += page.object_list
+			if not page.has_next():
+				break
+			cursor = page.next_cursor
+		self.assertEqual(seen, self.ids)
+
+	def test_bad_cursor_values(self):
+		bad = [
+			('not a cursor', ('-id',)),
+			(encode_cursor(['abc'], 'n'), ('-id',)),
+			(encode_cursor(['cheap', 1], 'n'), ('effective_price', 'id')),
+			(encode_cursor([{'a': 1}], 'n'), ('-id',)),
+			(encode_cursor([None, None], 'n'), ('name', 'id')),
+			(encode_cursor([1, 2], 'n'), ('-id',)),
+			(encode_cursor(['Infinity', 1], 'n'), ('effective_price', 'id')),
+			(encode_cursor([10 ** 30], 'n'), ('-id',)),
+		]
+		for cursor, ordering in bad:
+			with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+				keyset_paginate(Product.objects.all(), cursor, 3, ordering=ordering)
+
+	def test_bad_cursor_ids(self):
+		ids = BitsetIds(bits_of(self.ids))
+		for values in (['abc'], [-1], [10 ** 11], [max(self.ids) + 1, 1]):
+			with self.subTest(values=values), self.assertRaises(InvalidCursor):
+				keyset_paginate_ids(ids, encode_cursor(values, 'n'), 4, max(self.ids))
+		# Huge pivots never build huge masks
+		self.assertEqual(len(ids.before(10 ** 11)), len(ids))
+		self.assertEqual(len(ids.after(10 ** 11)), 0)
+
+	def test_bad_cursor_responses(self):
+		requests = [
+			('home', {'cursor': encode_cursor(['abc'], 'n')}),
+			('home', {'cat_cursor': encode_cursor([None, None], 'n')}),
+			('search', {'sort': 'price_asc', 'cursor': encode_cursor(['cheap', 1], 'n')}),
+			('products_more', {'cursor': encode_cursor([{'a': 1}], 'n')}),
+		]
+		for name, params in requests:
+			with self.subTest(name=name, params=params):
+				response = self.client.get(reverse(name), params, secure=True)
+				self.assertEqual(response.status_code, 400)
+
+
+class FacetIndexTests(TestCase):
+	"""The facet index finds and counts the same products as the SQL filters"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.sizes = [HeadSize.objects.create(cm=str(cm), inches='', standard_size='') for cm in (55, 57, 59)]
+		Product.objects.bulk_create([
+			Product(
+				name=f'Product {i}',
+				price=10 + i,
+				sale_price=5 + i,
+				effective_price=5 + i if i % 4 == 0 else 10 + i,
+				is_sale=i % 4 == 0,
+				category=hats,
+				color=['Black', 'Red', 'Beige', None][i % 4],
+				material=['Wool', 'Felt', 'Straw'][i % 3],
+				allow_custom_size=i % 5 == 0,
+			)
+			for i in range(60)
+		])
+		for i, product in enumerate(Product.objects.order_by('id')):
+			product.head_sizes.set(cls.sizes[:i % 4])
+
+	def setUp(self):
+		self.index = FacetIndex()
+		self.index.build()
+
+	def filters(self):
+		yield ''
+		yield 'color=Black'
+		yield 'color=Black&color=Red'
+		yield 'material=Felt'
+		yield f'head_size={self.sizes[1].pk}'
+		yield f'head_size={self.sizes[0].pk}&head_size={self.sizes[2].pk}&color=Beige'
+		yield 'price_min=20&price_max=40'
+		yield 'price_max=15&material=Wool'
+		yield 'custom_size_available=on'
+		yield f'color=Red&material=Straw&head_size={self.sizes[0].pk}&price_min=12&custom_size_available=on'
+		yield 'color=Purple'
+
+	def sql_ids(self, params):
+		return [product.id for product in search_queryset(QueryDict(params))]
+
+	def assertMatchesSql(self, params):
+		self.assertEqual(self.index.match(**parse_filters(QueryDict(params)))[:], self.sql_ids(params))
+
+	def test_bits_of(self):
+		self.assertEqual(bits_of([]), 0)
+		self.assertEqual(bits_of([70, 0, 9, 9]), 1 | 1 << 9 | 1 << 70)
+
+	def test_match(self):
+		for params in self.filters():
+			with self.subTest(params=params):
+				self.assertMatchesSql(params)
+
+	def test_counts(self):
+		facets = {
+			'color': ['Black', 'Red', 'Beige'],
+			'material': ['Wool', 'Felt', 'Straw'],
+			'head_size': [size.pk for size in self.sizes],
+		}
+		for params in self.filters():
+			counts = self.index.counts(**parse_filters(QueryDict(params)))
+			for facet, values in facets.items():
+				for value in values:
+					# The count of a value is the result with only that value of the facet ticked
+					query = QueryDict(params, mutable=True)
+					query.setlist(facet, [str(value)])
+					with self.subTest(params=params, facet=facet, value=value):
+						self.assertEqual(counts[facet].get(value, 0), len(self.sql_ids(query.urlencode())))
+			query = QueryDict(params, mutable=True)
+			query['custom_size_available'] = 'on'
+			with self.subTest(params=params, facet='custom_size'):
+				self.assertEqual(counts['custom_size'], len(self.sql_ids(query.urlencode())))
+
+	def test_incremental_updates(self):
+		product = Product.objects.filter(color='Black').first()
+		product.color = 'Red'
+		product.is_sale = True
+		product.sale_price = 1
+		product.save()
+		self.index.update_product(product)
+		gone = Product.objects.filter(material='Felt').first()
+		gone_pk = gone.pk
+		gone.delete()
+		self.index.remove_product(gone_pk)
+		self.sizes[1].product_set.set(Product.objects.filter(color='Beige'))
+		self.index.reload_head_sizes()
+		for params in self.filters():
+			with self.subTest(params=params):
+				self.assertMatchesSql(params)
+
+	def test_version_bumped_on_commit(self):
+		product = Product.objects.first()
+		before = current_version()
+		with self.captureOnCommitCallbacks() as callbacks:
+			product.save()
+			# Other workers must not rebuild from uncommitted rows
+			self.assertEqual(current_version(), before)
+		for callback in callbacks:
+			callback()
+		self.assertNotEqual(current_version(), before)
+
+
+class SearchFilterTests(TestCase):
+	"""The search view filters the same with a warm index and with SQL"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		Product.objects.bulk_create([
+			Product(name=f'Product {i}', price=10 * i, effective_price=10 * i, category=hats,
+					color=['Black', 'Red'][i % 2], image='uploads/product/hat.jpg')
+			for i in range(1, 7)
+		])
+
+	def search(self, params, index):
+		with mock.patch('store.views.get_index', return_value=index):
+			response = self.client.get(reverse('search'), params, secure=True)
+		self.assertEqual(response.status_code, 200)
+		return [product.name for product in response.context['products']]
+
+	def test_same_results(self):
+		index = FacetIndex()
+		index.build()
+		bad = {'price_min': 'abc', 'price_max': 'NaN', 'head_size': 'x'}
+		for params in ({'price_min': '25'}, {'price_min': '20', 'price_max': '40', 'color': 'Red'}, bad,
+					   dict(bad, color='Black'), {'price_max': 'Infinity'}):
+			with self.subTest(params=params):
+				self.assertEqual(self.search(params, None), self.search(params, index))
+		# Bad values are ignored
+		self.assertEqual(len(self.search(bad, None)), 6)
+
+
+class PageCacheTests(TestCase):
+	"""Shared pages are served from the cache until a save purges them"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.hats = Category.objects.create(name='Hats')
+		cls.gifts = Category.objects.create(name='Gifts')
+		cls.product = Product.objects.create(name='Felt Fedora', price=20, category=cls.hats,
+											 image='uploads/product/fedora.jpg')
+
+	def setUp(self):
+		cache.clear()
+
+	def get(self, url):
+		return self.client.get(url, secure=True).content.decode()
+
+	def save(self, instance):
+		# Purges run once the save commits
+		with self.captureOnCommitCallbacks(execute=True):
+			instance.save()
+
+	def test_product_save_purges_home(self):
+		self.assertIn('Felt Fedora', self.get(reverse('home')))
+		# No signals, so the cached page stays
+		Product.objects.filter(pk=self.product.pk).update(name='Straw Boater')
+		self.assertIn('Felt Fedora', self.get(reverse('home')))
+
+		self.product.name = 'Wool Beret'
+		self.save(self.product)
+		page = self.get(reverse('home'))
+		self.assertIn('Wool Beret', page)
+		self.assertNotIn('Felt Fedora', page)
+
+	def test_category_change_purges_both_listings(self):
+		hats_url = reverse('category', args=[self.hats.slug])
+		gifts_url = reverse('category', args=[self.gifts.slug])
+		self.assertIn('Felt Fedora', self.get(hats_url))
+		self.assertNotIn('Felt Fedora', self.get(gifts_url))
+
+		self.product.category = self.gifts
+		self.save(self.product)
+		self.assertNotIn('Felt Fedora', self.get(hats_url))
+		self.assertIn('Felt Fedora', self.get(gifts_url))
+
+	def test_related_refresh_purges_the_product_page(self):
+		url = reverse('product', args=[self.product.pk])
+		self.assertNotIn('Straw Boater', self.get(url))
+		# No signals: only the refresh knows about it
+		Product.objects.bulk_create([Product(name='Straw Boater', price=20, category=self.hats,
+											 image='uploads/product/boater.jpg')])
+		with self.captureOnCommitCallbacks(execute=True):
+			refresh_related(self.product)
+		self.assertIn('Straw Boater', self.get(url))
+
+	def test_category_rename_purges_its_product_pages(self):
+		url = reverse('product', args=[self.product.pk])
+		self.assertIn('Hats', self.get(url))
+		self.hats.name = 'Caps'
+		self.save(self.hats)
+		self.assertIn('Caps', self.get(url))
+
+
+def image_bytes(mode, size, image_format, noise=False):
+	if noise:
+		img = Image.merge('RGB', [Image.effect_noise(size, 80)] * 3)
+	else:
+		img = Image.new(mode, size, 'red' if mode in ('RGB', 'RGBA', 'CMYK') else 128)
+	buffer = BytesIO()
+	img.save(buffer, format=image_format)
+	return buffer.getvalue()
+
+
+class MediaTestMixin():
+	"""Files go to a temporary MEDIA_ROOT on the local disk"""
+	def setUp(self):
+		self.media = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.media)
+		storage = override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+									MEDIA_ROOT=self.media)
+		storage.enable()
+		self.addCleanup(storage.disable)
+
+
+class ImageJobTests(MediaTestMixin, TestCase):
+	"""Uploads are stored as they are and swapped for the processed image by a job"""
+	def setUp(self):
+		super().setUp()
+		self.category = Category.objects.create(name='Hats')
+
+	def create_product(self, name, data):
+		# Jobs are queued once the save commits
+		with self.captureOnCommitCallbacks(execute=True):
+			return Product.objects.create(name=name, price=20, category=self.category,
+										  image=SimpleUploadedFile(f'{name}.png', data))
+
+	def run_jobs(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			return [images.process_job(job) for job in images.claim_jobs(10)]
+
+	def test_run_job(self):
+		product = self.create_product('fedora', image_bytes('RGB', (2400, 1200), 'PNG'))
+		original = product.image.name
+		self.assertTrue(product.image.storage.exists(original))
+
+		self.assertEqual(self.run_jobs(), [True])
+		self.assertEqual(ImageJob.objects.get().status, ImageJob.DONE)
+		product.refresh_from_db()
+		self.assertTrue(product.image.name.endswith('.jpg'))
+		# The original upload is superseded
+		self.assertFalse(product.image.storage.exists(original))
+		with Image.open(product.image.path) as img:
+			self.assertEqual(img.size, (1920, 960))
+		manifest = product.image_variants['image']
+		self.assertEqual(manifest['name'], product.image.name)
+		self.assertEqual(manifest['width'], 1920)
+
+	def test_upload_that_cannot_be_compressed(self):
+		# Over the size limit and too large to decode: stored as it is, the job records the error
+		with mock.patch('store.models.MAX_FILE_SIZE', 1000), \
+				mock.patch.object(images, 'MAX_DECODED_PIXELS', 1000 * 1000):
+			product = self.create_product('fedora', image_bytes('RGB', (1500, 1000), 'PNG'))
+			self.assertTrue(product.image.name.endswith('.png'))
+			self.assertTrue(product.image.storage.exists(product.image.name))
+			self.assertEqual(self.run_jobs(), [False])
+		job = ImageJob.objects.get()
+		self.assertEqual(job.status, ImageJob.PENDING)
+		self.assertIn('too large', job.error)
+
+	def test_replaced_before_the_job_runs(self):
+		product = self.create_product('fedora', image_bytes('RGB', (400, 300), 'PNG'))
+		first = product.image.name
+		with self.captureOnCommitCallbacks(execute=True):
+			product.image = SimpleUploadedFile('boater.png', image_bytes('L', (400, 300), 'PNG'))
+			product.save()
+
+		self.run_jobs()
+		product.refresh_from_db()
+		self.assertEqual(product.image_variants['image']['name'], product.image.name)
+		# The first upload was never used
+		self.assertFalse(product.image.storage.exists(first))
+
+	def test_same_upload_reuses_processed_image(self):
+		data = image_bytes('RGB', (2400, 1200), 'PNG')
+		product = self.create_product('fedora', data)
+		self.run_jobs()
+		product.refresh_from_db()
+
+		# The same picture uploaded again points at the processed file and variants
+		copy = self.create_product('copy', data)
+		self.assertEqual(copy.image.name, product.image.name)
+		self.assertEqual(copy.image_variants['image'], product.image_variants['image'])
+		self.assertEqual(images.claim_jobs(10), [])
+
+
+class VariantTests(MediaTestMixin, TestCase):
+	"""Every image gets a ladder of widths in every variant format"""
+	def test_make_variants(self):
+		img = images.load_image(image_bytes('RGB', (1000, 500), 'JPEG'))
+		manifest = images.make_variants(img, FileSystemStorage(location=self.media), 'ab' * 32)
+		self.assertEqual((manifest['width'], manifest['height']), (1000, 500))
+		self.assertEqual([source['type'] for source in manifest['sources']],
+						 [content_type for _, _, content_type, _ in images.VARIANT_FORMATS])
+		for source in manifest['sources']:
+			# Never upscaled past the image itself
+			self.assertEqual([width for width, _ in source['files']], [320, 640, 960, 1000])
+			for width, name in source['files']:
+				self.assertTrue(name.startswith(f'uploads/variants/ab/{"ab" * 32}-{width}.'))
+				with Image.open(f'{self.media}/{name}') as variant:
+					self.assertEqual(variant.size, (width, width // 2))
+
+	def test_responsive_image_tag(self):
+		product = Product(name='Fedora', image='uploads/product/fedora.jpg')
+		# No variants yet: a plain <img>
+		self.assertNotIn('<picture>', responsive_image(product))
+		product.image_variants['image'] = images.make_variants(
+			images.load_image(image_bytes('RGB', (1000, 500), 'JPEG')), FileSystemStorage(location=self.media), 'cd' * 32)
+		product.image_variants['image']['name'] = product.image.name
+		html = responsive_image(product, alt='Fedora')
+		self.assertIn('<picture>', html)
+		self.assertIn('type="image/webp"', html)
+		self.assertIn(' 1000w', html)
+		# Variants of a file the field no longer holds are not shown
+		product.image = 'uploads/product/boater.jpg'
+		self.assertNotIn('<picture>', responsive_image(product))
+
+
+class CompressImageTests(TestCase):
+	"""compress_image finds the best quality within the size budget"""
+	def setUp(self):
+		self.img = Image.open(BytesIO(image_bytes('RGB', (800, 600), 'PNG', noise=True)))
+		smallest = BytesIO()
+		self.img.save(smallest, format='JPEG', quality=images.MIN_QUALITY, optimize=True)
+		self.smallest = len(smallest.getvalue())
+
+	def test_fits_at_max_quality(self):
+		content = images.compress_image(self.img)
+		self.assertLessEqual(len(content), images.MAX_FILE_SIZE)
+		self.assertEqual(Image.open(BytesIO(content)).size, (800, 600))
+
+	def test_searches_the_quality(self):
+		with mock.patch.object(images, 'MAX_FILE_SIZE', self.smallest * 3):
+			content = images.compress_image(self.img)
+		self.assertLessEqual(len(content), self.smallest * 3)
+		self.assertEqual(Image.open(BytesIO(content)).size, (800, 600))
+
+	def test_scales_down_below_min_quality(self):
+		with mock.patch.object(images, 'MAX_FILE_SIZE', self.smallest // 2), \
+				self.assertLogs('store.images', 'INFO') as logs:
+			content = images.compress_image(self.img)
+		self.assertLessEqual(len(content), self.smallest // 2)
+		self.assertLess(Image.open(BytesIO(content)).width, 800)
+		# The downscale is within the encode budget too
+		encodes = int(re.search(r'(\d+) encodes', logs.output[-1]).group(1))
+		self.assertLessEqual(encodes, images.MAX_ENCODES)
+
+	def test_does_not_fit(self):
+		with mock.patch.object(images, 'MAX_FILE_SIZE', 100), self.assertRaises(ValueError):
+			images.compress_image(self.img)
+
+
+class LoadImageTests(TestCase):
+	"""load_image resizes before converting and refuses huge images"""
+	def test_modes(self):
+		cases = [
+			('RGB', 'JPEG', 'RGB'),
+			('CMYK', 'JPEG', 'RGB'),
+			('L', 'PNG', 'L'),
+			('LA', 'PNG', 'L'),
+			('RGBA', 'PNG', 'RGB'),
+			('P', 'PNG', 'RGB'),
+		]
+		for mode, image_format, expected in cases:
+			with self.subTest(mode=mode):
+				img = images.load_image(image_bytes(mode, (400, 300), image_format))
+				self.assertEqual(img.mode, expected)
+				self.assertEqual(img.size, (400, 300))
+
+	def test_resizes(self):
+		img = images.load_image(image_bytes('RGB', (4000, 3000), 'JPEG'))
+		self.assertEqual(img.size, (1920, 1440))
+		img = images.load_image(image_bytes('RGBA', (1000, 3000), 'PNG'))
+		self.assertEqual(img.size, (640, 1920))
+
+	def test_too_large(self):
+		with mock.patch.object(images, 'MAX_DECODED_PIXELS', 4 * 1000 * 1000):
+			with self.assertRaises(ValueError):
+				images.load_image(image_bytes('RGB', (2500, 2000), 'PNG'))
+			# JPEGs are measured after draft scaling
+			self.assertEqual(images.load_image(image_bytes('RGB', (4000, 3000), 'JPEG')).size, (1920, 1440))
+
+
+class CacheInvalidationTests(TestCase):
+	"""Shared caches are only invalidated once the change commits"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.hats = Category.objects.create(name='Hats')
+
+	def setUp(self):
+		cache.clear()
+
+	def assertChangedOnCommit(self, read, change):
+		before = read()
+		with self.captureOnCommitCallbacks() as callbacks:
+			change()
+			# A concurrent request would cache the old rows again
+			self.assertEqual(read(), before)
+		for callback in callbacks:
+			callback()
+		self.assertNotEqual(read(), before)
+
+	def test_facets(self):
+		get_facets()
+		self.assertChangedOnCommit(
+			lambda: cache.get(FACET_CACHE_KEY),
+			lambda: Product.objects.create(name='Felt Fedora', price=20, color='Black', category=self.hats))
+
+	def test_autocomplete_version(self):
+		cache.set(AUTOCOMPLETE_VERSION_KEY, 'v1', None)
+		self.assertChangedOnCommit(
+			lambda: cache.get(AUTOCOMPLETE_VERSION_KEY),
+			lambda: Product.objects.create(name='Felt Fedora', price=20, category=self.hats))
+
+	def test_category_map_version(self):
+		cache.set(CATEGORY_VERSION_KEY, 'v1', None)
+		self.assertChangedOnCommit(
+			lambda: cache.get(CATEGORY_VERSION_KEY),
+			lambda: Category.objects.create(name='Gifts'))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite FTS5 search')
+class FullTextSearchTests(TestCase):
+	"""Product search through the FTS5 table, kept in step with saves and deletes"""
+	@classmethod
+	def setUpTestData(cls):
+		hats = Category.objects.create(name='Hats')
+		cls.fedora = Product.objects.create(name='Felt Fedora', description='A classic hat', category=hats)
+		cls.boater = Product.objects.create(name='Straw Boater', description='Pairs with a felt band', category=hats)
+		cls.beret = Product.objects.create(name='Wool Beret', description='Soft and warm', category=hats)
+
+	def setUp(self):
+		if backend() != 'fts5':
+			self.skipTest('SQLite built without FTS5')
+
+	def found(self, query):
+		return list(search_products(query).values_list('name', flat=True))
+
+	def test_name_matches_rank_first(self):
+		self.assertEqual(self.found('felt'), ['Felt Fedora', 'Straw Boater'])
+
+	def test_prefixes_of_every_word(self):
+		self.assertEqual(self.found('fed'), ['Felt Fedora'])
+		self.assertEqual(self.found('FELT bo'), ['Straw Boater'])
+		self.assertEqual(self.found('felt, wool!'), [])
+
+	def test_results_are_capped(self):
+		with mock.patch('store.search.MAX_FTS_RESULTS', 1):
+			self.assertEqual(self.found('felt'), ['Felt Fedora'])
+
+	def test_save_and_delete_update_the_index(self):
+		self.beret.name = 'Felt Beret'
+		self.beret.save()
+		self.assertIn('Felt Beret', self.found('felt'))
+		self.assertEqual(self.found('wool'), [])
+
+		self.fedora.delete()
+		self.assertEqual(self.found('fedora'), [])
+		self.assertNotIn('Felt Fedora', self.found('felt'))
+
+
+class CategoryViewTests(TestCase):
+	"""Category pages are found by slug, id or old style name"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.gifts = Category.objects.create(name='Gift Card')
+		Product.objects.create(name='Felt Fedora', price=20, category=cls.gifts, image='uploads/product/fedora.jpg')
+
+	def setUp(self):
+		cache.clear()
+
+	def get(self, value):
+		return self.client.get(reverse('category', args=[value]), secure=True)
+
+	def test_lookups(self):
+		self.assertEqual(self.gifts.slug, 'gift-card')
+		for value in ('gift-card', str(self.gifts.pk), 'Gift Card', 'gift card'):
+			with self.subTest(value=value):
+				response = self.get(value)
+				self.assertEqual(response.status_code, 200)
+				self.assertEqual(response.context['category'], self.gifts)
+				self.assertContains(response, 'Felt Fedora')
+		self.assertRedirects(self.get('no-such-category'), reverse('home'), fetch_redirect_response=False)
+
+	def test_unique_slugs(self):
+		self.assertEqual(Category.objects.create(name='Gift card!').slug, 'gift-card-2')
+
+	def test_renamed(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			self.gifts.name = 'Gift Vouchers'
+			self.gifts.save()
+		self.assertEqual(self.gifts.slug, 'gift-vouchers')
+		self.assertEqual(self.get('gift-vouchers').context['category'], self.gifts)
+		# The old slug is free again
+		self.assertRedirects(self.get('gift-card'), reverse('home'), fetch_redirect_response=False)
+
+
+class ProductsMoreTests(TestCase):
+	"""The load more endpoint pages product cards as HTML or JSON"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.hats = Category.objects.create(name='Hats')
+		gifts = Category.objects.create(name='Gifts')
+		Product.objects.bulk_create([
+			Product(name=f'Product {i}', price=10 + i, effective_price=10 + i, image='uploads/product/hat.jpg',
+					category=cls.hats if i % 2 else gifts)
+			for i in range(12)
+		])
+
+	def get(self, **params):
+		return self.client.get(reverse('products_more'), params, secure=True)
+
+	def test_json_pages(self):
+		first = self.get(format='json').json()
+		self.assertEqual(len(first['products']), 8)
+		self.assertEqual(first['products'][0]['name'], 'Product 11')
+		self.assertEqual(set(first['products'][0]), {
+			'id', 'name', 'price', 'sale_price', 'effective_price', 'sold_out', 'is_unique', 'image', 'url'})
+		rest = self.get(format='json', cursor=first['next_cursor']).json()
+		self.assertEqual([p['name'] for p in rest['products']], [f'Product {i}' for i in range(3, -1, -1)])
+		self.assertIsNone(rest['next_cursor'])
+
+	def test_category_html(self):
+		data = self.get(category=self.hats.slug).json()
+		self.assertEqual(data['html'].count('product-card'), 4)
+		self.assertIn('Product 11', data['html'])
+		self.assertNotIn('Product 10', data['html'])
+		self.assertIsNotNone(data['next_cursor'])
+
+	def test_unknown_category(self):
+		response = self.get(category='no-such-category')
+		self.assertEqual(response.status_code, 404)
+		self.assertEqual(response.json(), {'error': 'Category not found'})
+
+
+class WishlistCountTests(TestCase):
+	"""The navbar wishlist count is read only and cached"""
+	@classmethod
+	def setUpTestData(cls):
+		cls.user = User.objects.create_user('shopper', password='secret')
+		cls.product = Product.objects.create(
+			name='Hat', price=10, image='uploads/product/hat.jpg', category=Category.objects.create(name='Hats'))
+
+	def setUp(self):
+		cache.clear()
+		self.client.force_login(self.user)
+
+	def badge(self):
+		response = self.client.get(reverse('wishlist'), secure=True)
+		return re.search(r'id="wishlist_quantity">(\d+)<', response.content.decode()).group(1)
+
+	def test_no_wishlist_created(self):
+		self.assertEqual(self.badge(), '0')
+		self.assertFalse(Wishlist.objects.exists())
+
+	def test_cached_count(self):
+		self.badge()
+		self.assertEqual(cache.get(f'store:wishlist_count:{self.user.pk}'), 0)
+		self.client.get(reverse('add_to_wishlist', args=[self.product.pk]), secure=True)
+		self.assertEqual(self.badge(), '1')
+		self.user.wishlist.products.remove(self.product)
+		self.assertEqual(wishlist_count_for(self.user), 0)
@@ -17,6 +17,8 @@ urlpatterns = [
     path('category_summary/', views.category_summary, name='category_summary'),
     path('search/', views.search, name='search'),
     path('search-live/', views.search_live, name='search_live'),
+    path('products/more/', views.products_more, name='products_more'),
+    path('session-state/', views.session_state, name='session_state'),
  # Wishlist URLs
     path('wishlist/', views.wishlist_view, name='wishlist'),
     path('wishlist/add/<int:product_id>/', views.add_to_wishlist, name='add_to_wishlist'),
@@ -1,7 +1,8 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from .forms import ContactForm
-from .models import Product, Category, Profile, Wishlist, HeadSize
+from .models import Product, Category, Profile, Wishlist
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
@@ -9,19 +10,67 @@ from .forms import SignUpForm, UpdateUserForm, ChangePasswordForm, UserInfoForm
 from django.core.mail import send_mail
 from django.conf import settings
 from django.http import JsonResponse
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import never_cache
 from django.db import models
 from django.core.paginator import Paginator
 from payment.forms import ShippingForm
 from payment.models import ShippingAddress
 
 from django import forms
-from django.db.models import Q, Min, Max
-import json
-from cart.cart import Cart
-from django.utils.text import slugify
+from cart.cart import Cart, load_saved_cart
+from cart.models import CartLine
+from .search import search_products
+from .facets import get_facets
+from .facet_index import get_index, parse_filters
+from .autocomplete import autocomplete
+from .categories import all_categories, resolve_category
+from .related import related_products_for
+from .pagination import keyset_paginate, keyset_paginate_ids
+from .page_cache import cache_shared_page
+from .cards import product_cards
+from .wishlists import request_wishlist_count
+
+# The search grid also shows the size options
+SEARCH_CARD_FIELDS = ('allow_custom_size',)
+# ?sort= options, by the indexed effective price (id breaks ties for the cursor)
+SEARCH_ORDERINGS = {
+    'price_asc': ('effective_price', 'id'),
+    'price_desc': ('-effective_price', '-id'),
+}
+
+def search_queryset(params):
+    """The search results from SQL, for when the facet index is not used"""
+    query = params.get('q', '')
+    ordering = SEARCH_ORDERINGS.get(params.get('sort', ''))
+    # Card columns only
+    products = product_cards(extra_fields=SEARCH_CARD_FIELDS).prefetch_related('head_sizes')
 
-from django.views.decorators.cache import cache_page
+    if query:
+        # Full-text search, best matches first
+        products = search_products(query, products)
+    if ordering:
+        products = products.order_by(*ordering)
+    elif not query:
+        products = products.order_by('-id')
+    # Same parsing as the facet index, so bad values are ignored on both paths
+    filters = parse_filters(params)
+    # Sale items are filtered on their sale price
+    if filters['price_min'] is not None:
+        products = products.filter(effective_price__gte=filters['price_min'])
+    if filters['price_max'] is not None:
+        products = products.filter(effective_price__lte=filters['price_max'])
+    if filters['colors']:
+        products = products.filter(color__in=filters['colors'])
+    if filters['head_sizes']:
+        # Filter products that have the selected head sizes
+        products = products.filter(head_sizes__id__in=filters['head_sizes']).distinct()
+    if filters['materials']:
+        products = products.filter(material__in=filters['materials'])
+    if filters['custom_size']:  # Filter for products that allow custom sizes
+        products = products.filter(allow_custom_size=True)
+    return products
 
 def search(request):
     query = request.GET.get('q', '')
@@ -31,38 +80,52 @@ def search(request):
     head_sizes = request.GET.getlist('head_size')
     materials = request.GET.getlist('material')
     custom_size_available = request.GET.get('custom_size_available')  # New filter for custom size
+    sort = request.GET.get('sort', '')
+    ordering = SEARCH_ORDERINGS.get(sort)
 
-    products = Product.objects.all()
-
-    if query:
-        products = products.filter(Q(name__icontains=query) | Q(description__icontains=query))
-    if price_min:
-        products = products.filter(price__gte=price_min)
-    if price_max:
-        products = products.filter(price__lte=price_max)
-    if colors:
-        products = products.filter(color__in=colors)
-    if head_sizes:
-        # Filter products that have the selected head sizes
-        products = products.filter(head_sizes__id__in=head_sizes).distinct()
-    if materials:
-        products = products.filter(material__in=materials)
-    if custom_size_available:  # Filter for products that allow custom sizes
-        products = products.filter(allow_custom_size=True)
-
-    categories = Category.objects.all()
-
-    # Pagination: 6 products per page
-    paginator = Paginator(products, 8)
+    categories = all_categories()
     page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Old numbered links still work, everything else pages by cursor
+    cursor = request.GET.get('cursor')
+    use_cursor = page_number is None
+
+    # Filter data, from the cached facet catalog
+    facets = get_facets()
+    head_sizes_db = facets['head_sizes']
+    colors_db = facets['colors']
+    materials_db = facets['materials']
+    custom_size_count = facets['custom_size_count']
+
+    # Without a text query or price sort, filter with the in-memory bitmap index when it is warm
+    index = get_index() if not query and not ordering else None
+    if index is not None:
+        filters = parse_filters(request.GET)
+        # Pagination: 8 products per page, only the page is loaded from the DB
+        if use_cursor:
+            page_obj = keyset_paginate_ids(index.match(**filters), cursor, 8, index.all.bit_length())
+        else:
+            paginator = Paginator(index.match(**filters), 8)
+            page_obj = paginator.get_page(page_number)
+        page_obj.object_list = list(
+            product_cards(Product.objects.filter(id__in=page_obj.object_list), SEARCH_CARD_FIELDS)
+            .prefetch_related('head_sizes').order_by('-id'))
+
+        # Result counts if each filter value were also ticked
+        counts = index.counts(**filters)
+        head_sizes_db = [dict(h, count=counts['head_size'].get(h['id'], 0)) for h in head_sizes_db]
+        colors_db = [dict(c, count=counts['color'].get(c['value'], 0)) for c in colors_db]
+        materials_db = [dict(m, count=counts['material'].get(m['value'], 0)) for m in materials_db]
+        custom_size_count = counts['custom_size']
+    else:
+        products = search_queryset(request.GET)
 
-    # Filter data
-    head_sizes_db = HeadSize.objects.all().order_by('cm')
-    colors_db = Product.objects.values_list('color', flat=True).distinct().order_by('color')
-    materials_db = Product.objects.values_list('material', flat=True).distinct().order_by('material')
-    min_price_db = Product.objects.aggregate(Min('price'))['price__min'] or 0
-    max_price_db = Product.objects.aggregate(Max('price'))['price__max'] or 1000
+        # Pagination: 8 products per page. Ranked text searches keep numbered pages
+        if use_cursor and not query:
+            page_obj = keyset_paginate(products, cursor, 8, ordering=ordering or ('-id',),
+                                       approximate_total=True)
+        else:
+            paginator = Paginator(products, 8)
+            page_obj = paginator.get_page(page_number)
 
     context = {
         'products': page_obj,
@@ -70,14 +133,16 @@ def search(request):
         'head_sizes_db': head_sizes_db,
         'colors_db': colors_db,
         'materials_db': materials_db,
-        'min_price_db': min_price_db,
-        'max_price_db': max_price_db,
+        'min_price_db': facets['min_price'],
+        'max_price_db': facets['max_price'],
+        'custom_size_count': custom_size_count,
         'selected_head_sizes': head_sizes,
         'selected_colors': colors,
         'selected_materials': materials,
         'selected_price_min': price_min,
         'selected_price_max': price_max,
         'custom_size_available': custom_size_available,  # Add to context
+        'selected_sort': sort,
         'query': query,
         'page_obj': page_obj,
     }
@@ -188,34 +253,42 @@ def update_user(request):
         messages.success(request, "You Must Be Logged In To Access That Page!!")
         return redirect('home')
 
+@cache_shared_page(lambda request: ['categories'])
 def category_summary(request):
-    categories = Category.objects.all()
+    categories = all_categories()
     return render(request, 'category_summary.html', {"categories":categories})    
 
+def newest_products():
+    """The home grid: product cards, newest first"""
+    return product_cards(Product.objects.all().order_by('-id'))
+
+def category_products(category):
+    """A category's grid: its product cards, newest first"""
+    return product_cards(Product.objects.filter(category=category).order_by('-id'))
+
+def category_page_tags(request, foo):
+    cat = resolve_category(foo)
+    if not cat:
+        return None
+    return [f'category:{cat.id}', f'products:category:{cat.id}']
+
+@cache_shared_page(category_page_tags)
 def category(request, foo):
     # ------------------ Find Category ------------------
-    cat = None
-    if str(foo).isdigit():
-        cat = Category.objects.filter(id=int(foo)).first()
-    if not cat:
-        cat = Category.objects.filter(name__iexact=foo).first()
-    if not cat:
-        name_candidate = foo.replace('-', ' ')
-        cat = Category.objects.filter(name__iexact=name_candidate).first()
-    if not cat:
-        for c in Category.objects.all():
-            if slugify(c.name) == foo:
-                cat = c
-                break
+    # id, slug or old style name, from the cached category map
+    cat = resolve_category(foo)
     if not cat:
         messages.error(request, "That Category Doesn't Exist...")
         return redirect('home')
 
     # ------------------ Products with Pagination ------------------
-    product_list = Product.objects.filter(category=cat).order_by('-id')
-    paginator = Paginator(product_list, 4)  # 4 products per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    product_list = category_products(cat)
+    if request.GET.get('page'):
+        paginator = Paginator(product_list, 4)  # 4 products per page
+        page_obj = paginator.get_page(request.GET.get('page'))
+    else:
+        # Cursor pages cost the same however deep they are
+        page_obj = keyset_paginate(product_list, request.GET.get('cursor'), 4, approximate_total=True)
 
     return render(request, 'category.html', {
         'category': cat,
@@ -223,11 +296,12 @@ def category(request, foo):
         'page_obj': page_obj,   # for pagination controls
     })
 
+@cache_shared_page(lambda request, pk: [f'product:{pk}', 'head_sizes'])
 def product(request, pk):
-    product = Product.objects.get(id=pk)
+    product = Product.objects.select_related('category').prefetch_related('head_sizes').get(id=pk)
     
-    # Get related products (same category, exclude current product)
-    related_products = Product.objects.filter(category=product.category).exclude(id=product.id)[:4]  # Limit to 4 products
+    # Get related products (precomputed, see store.related)
+    related_products = related_products_for(product, limit=4)
     
     context = {
         'product': product,
@@ -235,18 +309,61 @@ def product(request, pk):
     }
     return render(request, 'product.html', context)
 
+def products_more(request):
+    """
+    The next batch of product cards after a cursor, for "load more" on the
+    home and category grids. Rendered card HTML by default, plain product
+    data with ?format=json.
+    """
+    product_list = newest_products()
+    per_page = 8
+    category_slug = request.GET.get('category')
+    if category_slug:
+        cat = resolve_category(category_slug)
+        if not cat:
+            return JsonResponse({'error': 'Category not found'}, status=404)
+        product_list = category_products(cat)
+        per_page = 4
+
+    page_obj = keyset_paginate(product_list, request.GET.get('cursor'), per_page)
+    data = {'next_cursor': page_obj.next_cursor}
+    if request.GET.get('format') == 'json':
+        data['products'] = [
+            {
+                'id': product.id,
+                'name': product.name,
+                'price': str(product.price),
+                'sale_price': str(product.sale_price) if product.is_sale else None,
+                'effective_price': str(product.effective_price),
+                'sold_out': product.sold_out,
+                'is_unique': product.is_unique,
+                'image': product.image.url if product.image else None,
+                'url': reverse('product', args=[product.id]),
+            }
+            for product in page_obj
+        ]
+    else:
+        data['html'] = render_to_string('product_cards.html', {'products': page_obj}, request=request)
+    return JsonResponse(data)
+
+@cache_shared_page(lambda request: ['products', 'categories'])
 def home(request):
     # ---------------- PRODUCTS ----------------
-    product_list = Product.objects.all().order_by('-id')  # newest first
-    paginator = Paginator(product_list, 8)  # 8 products per page
-    page_number = request.GET.get('page', 1)
-    page_obj = paginator.get_page(page_number)
+    product_list = newest_products()
+    if request.GET.get('page'):
+        paginator = Paginator(product_list, 8)  # 8 products per page
+        page_obj = paginator.get_page(request.GET.get('page'))
+    else:
+        page_obj = keyset_paginate(product_list, request.GET.get('cursor'), 8, approximate_total=True)
 
     # ---------------- CATEGORIES ----------------
     category_list = Category.objects.all().order_by('name')
-    cat_paginator = Paginator(category_list, 8)  # 8 categories per page
-    cat_page_number = request.GET.get('cat_page', 1)
-    cat_page_obj = cat_paginator.get_page(cat_page_number)
+    if request.GET.get('cat_page'):
+        cat_paginator = Paginator(category_list, 8)  # 8 categories per page
+        cat_page_obj = cat_paginator.get_page(request.GET.get('cat_page'))
+    else:
+        # Name is not unique, so the id breaks ties
+        cat_page_obj = keyset_paginate(category_list, request.GET.get('cat_cursor'), 8, ordering=('name', 'id'))
 
     return render(request, "home.html", {
         "products": page_obj,       # paginated products
@@ -264,68 +381,9 @@ def login_user(request):
             login(request, user)
 
             # Do some shopping cart stuff
-            current_user = Profile.objects.get(user__id=request.user.id)
-            # Get their saved cart from database
-            saved_cart = current_user.old_cart
-            # Convert database string to python dictionary
-            if saved_cart and saved_cart.strip():  # Check if cart is not empty
-                try:
-                    # Convert to dictionary using JSON
-                    converted_cart = json.loads(saved_cart)
-                    # Add the loaded cart dictionary to our session
-                    # Get the cart
-                    cart = Cart(request)
-                    # Loop thru the cart and add the items from the database
-                    for product_id, item_data in converted_cart.items():
-                        try:
-                            # Skip if product_id is not a valid integer
-                            if not str(product_id).isdigit():
-                                print(f"Skipping invalid product ID: {product_id}")
-                                continue
-                                
-                            # Convert to integer
-                            product_id_int = int(product_id)
-                            
-                            # Get the product
-                            product = Product.objects.get(id=product_id_int)
-                            
-                            # Extract the individual values from the item_data dictionary
-                            # Handle both old format (just quantity) and new format (dictionary)
-                            if isinstance(item_data, dict):
-                                quantity = item_data.get('quantity', 1)
-                                selected_size = item_data.get('selected_size', '')
-                                custom_size = item_data.get('custom_size', '')
-                            else:
-                                # Old format where item_data was just the quantity
-                                quantity = item_data
-                                selected_size = ''
-                                custom_size = ''
-                            
-                            # Add to cart using db_add with individual parameters
-                            cart.db_add(
-                                product=product, 
-                                quantity=quantity, 
-                                selected_size=selected_size, 
-                                custom_size=custom_size
-                            )
-                            
-                        except Product.DoesNotExist:
-                            # Product might have been deleted, skip it
-                            continue
-                        except ValueError as e:
-                            # Handle conversion errors
-                            continue
-                        except Exception as e:
-                            # Handle any other errors
-                            continue
-                            
-                except json.JSONDecodeError as e:
-                    # If JSON is invalid, start with empty cart
-                    print(f"JSON decode error: {e}")
-                    pass
-                except Exception as e:
-                    print(f"Unexpected error restoring cart: {e}")
-                    # Continue with empty cart
+            # Add their saved cart from the database to our session in one go
+            cart = Cart(request)
+            cart.restore_saved(increment=True)
 
             messages.success(request, ("You Have Been Logged In!"))
             return redirect('home')
@@ -360,44 +418,34 @@ def register_user(request):
     else:
         return render(request, 'register.html', {'form':form})
 
+@never_cache
+def session_state(request):
+    """
+    The visitor's own navbar state, filled into shared cached pages.
+    """
+    return JsonResponse({
+        'authenticated': request.user.is_authenticated,
+        'is_staff': request.user.is_staff,
+        'cart_count': len(request.session.get('session_key', {})),
+        'wishlist_count': request_wishlist_count(request),
+    })
+
 def search_live(request):
     query = request.GET.get('q', '')
-    products = Product.objects.filter(name__icontains=query)
-    collections = Category.objects.filter(name__icontains=query)
-
-    products_data = [
-        {
-            'id': product.id,
-            'name': product.name,
-            'price': f"${product.price}",
-            'image': product.image.url,
-        }
-        for product in products
-    ]
-
-    collections_data = [
-        {
-            'id': collection.id,
-            'name': collection.name,
-            'slug': slugify(collection.name),
-            'description': collection.description,
-            'image': collection.image.url if collection.image else '/static/images/placeholder.png',
-        }
-        for collection in collections
-    ]
-
-    return JsonResponse({'products': products_data, 'collections': collections_data})
+    # Capped, prefix-indexed matches, cached per normalized query
+    return JsonResponse(autocomplete.search(query))
 
 # Show wishlist (works for auth & guest)
 def wishlist_view(request):
     if request.user.is_authenticated:
-        # Get or create wishlist for user
-        wishlist, created = Wishlist.objects.get_or_create(user=request.user)
-        products = wishlist.products.all()
+        # Read only: no wishlist yet is just an empty list
+        products = Product.objects.filter(wishlisted_by__user=request.user)
     else:
         # For guests: get product IDs from session
         product_ids = request.session.get('wishlist', [])
         products = Product.objects.filter(id__in=product_ids)
+    # Cards show the category name too
+    products = product_cards(products, ('category__name',)).select_related('category')
     return render(request, 'wishlist.html', {'products': products})
 
 # Add product to wishlist
@@ -422,8 +470,9 @@ def remove_from_wishlist(request, product_id):
     product = get_object_or_404(Product, id=product_id)
 
     if request.user.is_authenticated:
-        wishlist, created = Wishlist.objects.get_or_create(user=request.user)
-        wishlist.products.remove(product)
+        wishlist = Wishlist.objects.filter(user=request.user).first()
+        if wishlist:
+            wishlist.products.remove(product)
         messages.info(request, f"{product.name} removed from your wishlist.")
     else:
         wishlist = request.session.get('wishlist', [])
@@ -434,6 +483,7 @@ def remove_from_wishlist(request, product_id):
 
     return redirect('wishlist')
 
+@cache_shared_page()
 def shipping_policy(request):
     """
     View to display the shipping policy page
@@ -443,6 +493,7 @@ def shipping_policy(request):
     }
     return render(request, 'shipping_policy.html', context)
 
+@cache_shared_page()
 def returns(request):
     """
     View to display the Returns & Refunds page
@@ -452,6 +503,7 @@ def returns(request):
     }
     return render(request, 'returns.html', context)
 
+@cache_shared_page()
 def term(request):
     """
     View to display the Returns & Refunds page
@@ -461,6 +513,7 @@ def term(request):
     }
     return render(request, 'term.html', context)
 
+@cache_shared_page()
 def privacy_policy(request):
     """
     View to display the Privacy Policy page
@@ -473,20 +526,12 @@ def privacy_policy(request):
 # Debug view to check cart data (remove in production)
 def debug_cart(request):
     if request.user.is_authenticated:
-        current_user = Profile.objects.get(user__id=request.user.id)
-        saved_cart = current_user.old_cart
+        saved_cart = load_saved_cart(request.user)
         print("Saved cart data:", saved_cart)
-        
-        if saved_cart:
-            try:
-                converted_cart = json.loads(saved_cart)
-                print("Converted cart:", converted_cart)
-                print("Cart items:")
-                for key, value in converted_cart.items():
-                    print(f"  Key: {key} (type: {type(key)})")
-                    print(f"  Value: {value} (type: {type(value)})")
-            except Exception as e:
-                print("Error:", e)
+        print("Cart items:")
+        for key, value in saved_cart.items():
+            print(f"  Key: {key} (type: {type(key)})")
+            print(f"  Value: {value} (type: {type(value)})")
         
         return JsonResponse({"status": "checked"})
     return JsonResponse({"status": "not authenticated"})
@@ -494,13 +539,12 @@ def debug_cart(request):
 # View to reset corrupted cart data
 def reset_cart(request):
     if request.user.is_authenticated:
-        current_user = Profile.objects.get(user__id=request.user.id)
-        current_user.old_cart = "{}"
-        current_user.save()
+        CartLine.objects.filter(user=request.user).delete()
         
         # Also clear session cart
         if 'session_key' in request.session:
             del request.session['session_key']
+        request.session.pop('saved_cart_digest', None)
         
         messages.success(request, "Cart has been reset.")
         return redirect('home')
@@ -0,0 +1,74 @@
+# store/wishlists.py
+"""
+Cached wishlist counts for the navbar.
+
+A user's count is read with one query, without creating a Wishlist, and
+kept in the cache until the signals below see their wishlist change.
+"""
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from .models import Product, Wishlist
+
+# The signals do the invalidation, the timeout only bounds unused entries
+WISHLIST_COUNT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _count_key(user_id):
+    return f'store:wishlist_count:{user_id}'
+
+
+def wishlist_count_for(user):
+    key = _count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = Wishlist.products.through.objects.filter(wishlist__user_id=user.pk).count()
+        cache.set(key, count, WISHLIST_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def request_wishlist_count(request):
+    """Wishlist count of the visitor: cached for users, from the session for guests"""
+    if request.user.is_authenticated:
+        return wishlist_count_for(request.user)
+    return len(request.session.get('wishlist', []))
+
+
+def forget_counts(user_ids):
+    cache.delete_many([_count_key(user_id) for user_id in user_ids])
+
+
+def _wishlist_users(product):
+    return list(Wishlist.objects.filter(products=product).values_list('user_id', flat=True))
+
+
+def wishlist_products_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # wishlist.products.add/remove/clear
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            forget_counts([instance.user_id])
+    elif action == 'pre_clear':
+        # product.wishlisted_by.clear(), read the wishlists before they are unlinked
+        instance._wishlist_users = _wishlist_users(instance)
+    elif action == 'post_clear':
+        forget_counts(getattr(instance, '_wishlist_users', []))
+    elif action in ('post_add', 'post_remove'):
+        forget_counts(Wishlist.objects.filter(pk__in=pk_set).values_list('user_id', flat=True))
+
+
+def product_deleting(sender, instance, **kwargs):
+    # The wishlist links are deleted without m2m signals
+    instance._wishlist_users = _wishlist_users(instance)
+
+
+def product_deleted(sender, instance, **kwargs):
+    forget_counts(getattr(instance, '_wishlist_users', []))
+
+
+def wishlist_deleted(sender, instance, **kwargs):
+    forget_counts([instance.user_id])
+
+
+m2m_changed.connect(wishlist_products_changed, sender=Wishlist.products.through)
+pre_delete.connect(product_deleting, sender=Product)
+post_delete.connect(product_deleted, sender=Product)
+post_delete.connect(wishlist_deleted, sender=Wishlist)